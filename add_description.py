@@ -1,9 +1,53 @@
+from functools import lru_cache
 
+# description of one injected defect per strategy; {element} is the element's type and text, {bbox} its box
+DESCRIPTION_TEMPLATES = {
+    "CONTENT_ERROR": "The text of the {element} at {bbox} is garbled or replaced by placeholder characters.",
+    "CONTENT_REPEAT": "The text of the {element} at {bbox} is drawn twice over itself.",
+    "EL_OVERLAPPING": "The {element} at {bbox} overlaps another element.",
+    "EL_SCALING": "The {element} at {bbox} is scaled out of proportion with the elements around it.",
+    "EL_MISSING_BLANK": "The {element} at {bbox} is missing and leaves a blank space.",
+    "EL_MISSING_BROKEN_IMG": "The {element} at {bbox} shows a broken image instead of its content.",
+    "EL_MISALIGNED": "The {element} at {bbox} is out of line with the elements aligned with it.",
+    "UNEVEN_SPACE": "The row at {bbox} is blank, so the elements around it are unevenly spaced.",
+    "UNEXPECTED_TASK_RESULT": "The screen after the action on the {element} at {bbox} is not the expected result.",
+    "OPERATION_NO_RESPONSE": "The screen does not respond to the action on the {element} at {bbox}.",
+}
+DEFAULT_TEMPLATE = "The {element} at {bbox} has a {strategy} defect."
+# bound str.format of every template, looked up once per description
+_formatters = {strategy: template.format for strategy, template in DESCRIPTION_TEMPLATES.items()}
 
 
-"""
+@lru_cache(maxsize=4096)
+def describe_element(ui_type, ui_text):
+    """
+    Short name of an element: its class name without the package, followed by its text if it has one,
+    e.g. 'Button "Sign in"'.
+    """
+    name = (ui_type or "element").rsplit('.', 1)[-1] or "element"
+    text = " ".join(str(ui_text or "").split())
+    return f'{name} "{text}"' if text else name
+
+
+def format_bbox(bbox):
+    return "[" + ", ".join(str(int(round(v))) for v in bbox[:4]) + "]"
+
+
+def desc_generate(bbox, strategy, ui_type, ui_text):
+    """
+    Describe one injected defect.
+    :param bbox: box of the defective element
+    :param strategy: injection strategy
+    :param ui_type: element type (e.g. android.widget.Button)
+    :param ui_text: element text
+    :return: description sentence
+    """
+    formatter = _formatters.get(strategy)
+    element = describe_element(ui_type, ui_text)
+    if formatter is None:
+        return DEFAULT_TEMPLATE.format(element=element, bbox=format_bbox(bbox), strategy=strategy)
+    return formatter(element=element, bbox=format_bbox(bbox))
 
 
-"""
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    print(desc_generate([10, 20, 110, 60], "CONTENT_ERROR", "android.widget.Button", "Sign in"))
@@ -1,9 +1,12 @@
 import os
 import shutil
 import json
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 
 from add_description import desc_generate
+from uidm import records
+from uidm.pipeline import JsonArrayWriter
+from uidm.utils import is_json_array, iter_json_array, render_labels
 
 
 def copy_walk_dir(source_folder, destination_folder):
@@ -23,179 +26,187 @@ def copy_walk_dir(source_folder, destination_folder):
 
 
 def screenshot_labeled(image_path, ui_positions, texts=None, extra=[], rgba=(0, 0, 255), thickness=3):
-    screenshot = Image.open(image_path)
-    if texts is None:
-        texts = list(map(str, range(len(ui_positions))))
-    width, height = screenshot.size
-    if height < 900:
-        font_size = 12
-        thickness = 2
-    elif height < 1500:
-        font_size = 18
-        thickness = 3
-    else:
-        font_size = 42
-        thickness = 4
-    font = ImageFont.truetype('./resources/Roboto-Regular.ttf', size=font_size, encoding="utf-8")
-    with screenshot.convert('RGBA') as base:
-        tmp = Image.new('RGBA', base.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(tmp)
-        for idx, ui_position in enumerate(ui_positions):
-            x1, y1, x2, y2 = ui_position[:4]
-            if x1 == x2 or y1 == y2:
-                continue
-            if [x1, y1, x2, y2] not in extra:
-                draw.rectangle((x1, y1, x2, y2), outline=rgba, width=thickness)
-            else:
-                draw.rectangle((x1, y1, x2, y2), outline=(255, 0, 0), width=thickness)
-            left, top, right, bottom = font.getbbox(texts[idx])
-            coords = [
-                x1, y1,
-                x1 + right * 1.1, y1,
-                x1 + right * 1.1, y1 - bottom * 1.1,
-                x1, y1 - bottom * 1.1
-            ]
-            if [x1, y1, x2, y2] not in extra:
-                draw.polygon(coords, fill=rgba)
-            else:
-                draw.polygon(coords, fill=(255, 0, 0))
-            draw.text((x1, y1 - bottom * 1.05), texts[idx], fill=(255, 255, 255), font=font)
-        out = Image.alpha_composite(base, tmp)
-    return out
+    with Image.open(image_path) as screenshot:
+        return render_labels(screenshot, ui_positions, texts, extra, rgba, thickness)
 
 
 def aitw_process(dir):
     for subdir, _, files in os.walk(dir):
         for file in files:
-            if not file.endswith('.json'):
+            json_path = os.path.join(subdir, file)
+            if not file.endswith('.json') or not is_json_array(json_path):
                 continue
-            with open(os.path.join(subdir, file), 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    continue
-                for item in data:
-                    image_path = f'data/labeled_synthetic-data/{item.get("image_path", "")}'
-                    item['image_path'] = image_path
-                    ui_positions = []
-                    if 'ui_positions' in item:
-                        item['ui_positions'] = item['ui_positions'].replace('(', '[').replace(')', ']')
-                        ui_positions = json.loads(item['ui_positions'])
-                    if len(ui_positions) > 0:
-                        labeled = screenshot_labeled(image_path, ui_positions)
-                        labeled.save(image_path)
-                with open(os.path.join(subdir, file), 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=4)
+            path = records.ensure_records(json_path)
+            records.rewrite_prefixes(path, lambda prefix: f'data/labeled_synthetic-data/{prefix}', name='labeled')
+            for item in records.iter_records(path):
+                ui_positions = item.get('ui_positions') or []
+                if len(ui_positions) > 0:
+                    labeled = screenshot_labeled(item['image_path'], ui_positions)
+                    labeled.save(item['image_path'])
+
+
+def _crawler_prefix(prefix):
+    return f'data/labeled_synthetic-data/{prefix.replace("./", "").replace("original_cs_data", "Defective_Close_Source")}'
 
 
 def crawler_process(dir):
     for subdir, _, files in os.walk(dir):
         for file in files:
-            if not file.endswith('.json'):
+            json_path = os.path.join(subdir, file)
+            if not file.endswith('.json') or not is_json_array(json_path):
                 continue
-            with open(os.path.join(subdir, file), 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    continue
-                for item in data:
-                    if 'imgs_path' not in item:
-                        break
-                    item['imgs_path'] = [
-                        f'data/labeled_synthetic-data/{img_path.replace("./", "").replace("original_cs_data", "Defective_Close_Source")}'
-                        for img_path in item['imgs_path']]
-                    for idx, image_path in enumerate(item['imgs_path']):
-                        ui_positions = []
-                        item['ui_positions'][idx] = item['ui_positions'][idx].replace('(', '[').replace(')', ']')
-                        ui_positions = json.loads(item['ui_positions'][idx])
-                        if len(ui_positions) > 0:
-                            labeled = screenshot_labeled(image_path, ui_positions)
-                            labeled.save(image_path)
-                with open(os.path.join(subdir, file), 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=4)
+            path = records.ensure_records(json_path)
+            records.rewrite_prefixes(path, _crawler_prefix, name='labeled')
+            for item in records.iter_records(path):
+                if 'imgs_path' not in item:
+                    break
+                for idx, image_path in enumerate(item['imgs_path']):
+                    ui_positions = item['ui_positions'][idx]
+                    if len(ui_positions) > 0:
+                        labeled = screenshot_labeled(image_path, ui_positions)
+                        labeled.save(image_path)
         print(f"Processed {subdir}")
 
 
 UI_DISPLAY = ["Content Display Error", "UI Layout Issue", "UI Element Missing", "UI Consistency Issue"]
 
+UI_DISPLAY_PROMPT = (
+    "You are tasked with analyzing an app screenshot to identify any GUI "
+    "defects based on the following UI Display Defect types:\nDefect Types:\n- "
+    "Content Display Error: Text is unreadable or displays as garbled "
+    "characters (e.g., ‘□□□□’, null, or HTML entities), or appears in "
+    "incorrect or unexpected formats.\n- UI Layout Issue: Overlapping, "
+    "misaligned, or unevenly spaced elements clutter the page and obscure "
+    "content. For example, an image or text element overlaps another, "
+    "or similar elements have inconsistent spacing.\n- UI Element Missing: "
+    "Essential UI element is absent, causing functionality issues or abnormal "
+    "blank spaces. For example, image not loaded or displayed broken.\n- UI "
+    "Consistency Issue: Inconsistent colors, element sizes, or states. For "
+    "example, some navigation icons have different colors, font sizes vary, "
+    "or a button appears active without interaction.\nTask:\nAnalyze the app "
+    "screenshot to determine if any of the defects above are present. Based on "
+    "your findings, output only the defect(s) exactly as listed. If no defects "
+    "are observed, output No Defect.\nOutput Format:\n- If a defect is found, "
+    "output the defect name exactly as specified.\n- If no defects are found, "
+    "output: No Defect\nExamples:\nData Display Content Error\nUI Element "
+    "Missing\nInconsistent Color\nNo Defect\nOnly output the specific defect("
+    "s) or \"No Defect\" if none are present. Do not provide any additional "
+    "explanations.\n"
+)
+# prompts of the aggregated dataset by reference ID; records refer to them by problem_id
+PROMPTS = {"ui_display": UI_DISPLAY_PROMPT}
+
+
+def prompts_path(dataset_path):
+    """Path of the prompt table written next to an aggregated dataset: <name>.prompts.json"""
+    return f'{os.path.splitext(dataset_path)[0]}.prompts.json'
+
+
+def iter_dataset(dataset_path):
+    """
+    Yield the records of an aggregated dataset with their prompt text in 'problem',
+    whether the prompts were interned (problem_id) or not.
+    """
+    prompts = {}
+    if os.path.exists(prompts_path(dataset_path)):
+        with open(prompts_path(dataset_path), 'r', encoding='utf-8') as f:
+            prompts = json.load(f)
+    for item in iter_json_array(dataset_path):
+        if 'problem_id' in item:
+            item['problem'] = prompts[item.pop('problem_id')]
+        yield item
+
 
-def json_in_all(root_dir):
-    with open('filtered_250326.json', 'r', encoding='utf-8') as f:
-        results = json.load(f)
-    counter_type = {"Content Display Error": 0, "UI Layout Issue": 0, "UI Element Missing": 0,
-                    "UI Consistency Issue": 0, "No Defect": 0}
-    for subdir, _, files in os.walk(root_dir):
-        print(f"Processing {subdir}")
-        for file in files:
-            if file.endswith('.json'):
+def _intern_prompt(item, prompts):
+    """
+    Item of an existing dataset (prompt text in 'problem', see iter_dataset) referring to its prompt by ID.
+    :param prompts: prompt table being written, extended with prompts it does not hold yet
+    """
+    if 'problem' not in item:
+        return item
+    problem_ids = {prompt: problem_id for problem_id, prompt in prompts.items()}
+    if item['problem'] not in problem_ids:
+        problem_ids[item['problem']] = f'prompt_{len(prompts)}'
+        prompts[problem_ids[item['problem']]] = item['problem']
+    return {('problem_id' if key == 'problem' else key): (problem_ids[value] if key == 'problem' else value)
+            for key, value in item.items()}
+
+
+def json_in_all(root_dir, dataset_path='filtered_250326.json', intern_prompts=True):
+    """
+    Aggregate the records under root_dir into one dataset file, after the items it already holds.
+    :param intern_prompts: refer to the prompt by its ID in PROMPTS (problem_id) and write the prompt table
+    once to prompts_path(dataset_path), instead of repeating the prompt in every record. The items already
+    in the dataset are rewritten in the same layout, so a file never mixes both.
+    """
+    problem = {'problem_id': 'ui_display'} if intern_prompts else {'problem': PROMPTS['ui_display']}
+    prompts = dict(PROMPTS)
+    with JsonArrayWriter(dataset_path, indent=2, ensure_ascii=False, append=False) as results:
+        if os.path.exists(dataset_path) and is_json_array(dataset_path):
+            for item in iter_dataset(dataset_path):
+                results.write(_intern_prompt(item, prompts) if intern_prompts else item)
+        counter_type = {"Content Display Error": 0, "UI Layout Issue": 0, "UI Element Missing": 0,
+                        "UI Consistency Issue": 0, "No Defect": 0}
+        for subdir, _, files in os.walk(root_dir):
+            print(f"Processing {subdir}")
+            for file in files:
                 file_path = os.path.join(subdir, file)
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                    if isinstance(data, dict):
+                if file.endswith(records.RECORDS_SUFFIX):
+                    items = records.iter_records(file_path)
+                elif file.endswith('.json') and not os.path.exists(records.records_path(file_path)):
+                    if not is_json_array(file_path):
                         continue
-                    for item in data:
-                        reason = []
-                        if item.get('injected_defect', None):
-                            strategy = item['injected_defect']['strategy']
-                            s_idx = item['injected_defect']['idx']
-                            for key in item['injected_defect']['selected']:
-                                idx, bbox = key.split('|')
-                                idx = int(idx)
-                                bbox = json.loads(bbox)
-                                if idx and bbox:
-                                    ui_type = json.loads(item['ui_type'][s_idx])
-                                    ui_text = json.loads(item['ui_text'][s_idx])
-                                    reason.append(
-                                        desc_generate(bbox, strategy, ui_type[idx], ui_text[idx]))
-                            if "CONTENT" in strategy:
-                                injected_defect = f'Content Display Error'
-                            elif "MISSING" in strategy:
-                                injected_defect = f'UI Element Missing'
-                            elif strategy in ['EL_OVERLAPPING', 'EL_MISALIGNED', 'UNEVEN_SPACE']:
-                                injected_defect = f'UI Layout Issue'
-                            else:
-                                injected_defect = f'{strategy}'
-                            image_path = item.get('imgs_path', None)
-                            if not injected_defect or not image_path:
-                                continue
-                            if injected_defect and injected_defect.strip() in UI_DISPLAY:
-                                solution = injected_defect
-                            else:
-                                solution = 'No Defect'
+                    items = iter_json_array(file_path)
+                else:
+                    continue
+                for item in items:
+                    reason = []
+                    if item.get('injected_defect', None):
+                        strategy = item['injected_defect']['strategy']
+                        s_idx = item['injected_defect']['idx']
+                        # parsed on the first description needed, then shared by every selected element
+                        ui_type = ui_text = None
+                        for key in item['injected_defect']['selected']:
+                            idx, bbox = key.split('|')
+                            idx = int(idx)
+                            bbox = json.loads(bbox)
+                            if idx and bbox:
+                                if ui_type is None:
+                                    ui_type = records.parse_list(item['ui_type'][s_idx])
+                                    ui_text = records.parse_list(item['ui_text'][s_idx])
+                                reason.append(
+                                    desc_generate(bbox, strategy, ui_type[idx], ui_text[idx]))
+                        if "CONTENT" in strategy:
+                            injected_defect = f'Content Display Error'
+                        elif "MISSING" in strategy:
+                            injected_defect = f'UI Element Missing'
+                        elif strategy in ['EL_OVERLAPPING', 'EL_MISALIGNED', 'UNEVEN_SPACE']:
+                            injected_defect = f'UI Layout Issue'
+                        else:
+                            injected_defect = f'{strategy}'
+                        image_path = item.get('imgs_path', None)
+                        if not injected_defect or not image_path:
+                            continue
+                        if injected_defect and injected_defect.strip() in UI_DISPLAY:
+                            solution = injected_defect
                         else:
                             solution = 'No Defect'
-                        counter_type[solution] += 1
-                        for idx, image in enumerate(image_path):
-                            image = f'/data10/zkj/datasets/GTArena-UI-Defects/{image}'
-                            result = {
-                                'image': image,
-                                'problem': "You are tasked with analyzing an app screenshot to identify any GUI "
-                                           "defects based on the following UI Display Defect types:\nDefect Types:\n- "
-                                           "Content Display Error: Text is unreadable or displays as garbled "
-                                           "characters (e.g., ‘□□□□’, null, or HTML entities), or appears in "
-                                           "incorrect or unexpected formats.\n- UI Layout Issue: Overlapping, "
-                                           "misaligned, or unevenly spaced elements clutter the page and obscure "
-                                           "content. For example, an image or text element overlaps another, "
-                                           "or similar elements have inconsistent spacing.\n- UI Element Missing: "
-                                           "Essential UI element is absent, causing functionality issues or abnormal "
-                                           "blank spaces. For example, image not loaded or displayed broken.\n- UI "
-                                           "Consistency Issue: Inconsistent colors, element sizes, or states. For "
-                                           "example, some navigation icons have different colors, font sizes vary, "
-                                           "or a button appears active without interaction.\nTask:\nAnalyze the app "
-                                           "screenshot to determine if any of the defects above are present. Based on "
-                                           "your findings, output only the defect(s) exactly as listed. If no defects "
-                                           "are observed, output No Defect.\nOutput Format:\n- If a defect is found, "
-                                           "output the defect name exactly as specified.\n- If no defects are found, "
-                                           "output: No Defect\nExamples:\nData Display Content Error\nUI Element "
-                                           "Missing\nInconsistent Color\nNo Defect\nOnly output the specific defect("
-                                           "s) or \"No Defect\" if none are present. Do not provide any additional "
-                                           "explanations.\n",
-                                'solution': solution,
-                                'reason': reason
-                            }
-                            results.append(result)
-
+                    else:
+                        solution = 'No Defect'
+                    counter_type[solution] += 1
+                    for idx, image in enumerate(image_path):
+                        image = f'/data10/zkj/datasets/GTArena-UI-Defects/{image}'
+                        result = {
+                            'image': image,
+                            **problem,
+                            'solution': solution,
+                            'reason': reason
+                        }
+                        results.write(result)
+    if intern_prompts:
+        with open(prompts_path(dataset_path), 'w', encoding='utf-8') as f:
+            json.dump(prompts, f, indent=2, ensure_ascii=False)
     print(counter_type)
-    with open('filtered_250326.json', 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
 
 
 if __name__ == '__main__':
@@ -1,48 +1,134 @@
 import json
 import os
 import random
+import struct
 import sys
+from collections import Counter
+from dataclasses import dataclass
 from typing import List, Tuple
 
+import numpy as np
 from PIL import Image
 
 from config import load_config
-from uidm import utils
+from uidm import bboxes, memprofile, profiling, utils
+from uidm.pipeline import JsonArrayWriter
 from uidm.ui_defects import UIDefectInjection
 from uidm.utils import copy_walk_dir
-from uidm_main import ui_defect_mocker
+from uidm_main import inject_planned, load_injection_plan, plan_injection, print_plan_summary, ui_defect_mocker
 
 configs = load_config()
 
 
-def extract_ui_positions(img_size, bboxes: List[Tuple[float, float, float, float]]):
-    ex_bboxes = []
-    w, h = img_size
-    for idx, bbox in enumerate(bboxes):
-        y1, x1, height, width = bbox[:4]
-        x2, y2 = x1 + width, y1 + height
-        x1 = min(max(0, x1), w) - 5
-        x2 = min(max(x1, x2), w) + 5
-        y1 = min(max(0, y1), h) - 3
-        y2 = min(max(y1, y2), h) + 3
-        ex_bboxes.append((x1, y1, x2, y2))
-    return ex_bboxes
+def extract_ui_positions(img_size, yxhw: List[Tuple[float, float, float, float]]):
+    return [tuple(bbox) for bbox in
+            bboxes.from_yxhw([bbox[:4] for bbox in yxhw], img_size, bboxes.AITW_PAD).tolist()]
 
 
 def check_inside(x, y, bbox_array):
-    for idx, bbox in enumerate(bbox_array):
-        x_min, y_min, x_max, y_max = bbox
-        if (x_min <= x <= x_max) and (y_min <= y <= y_max):
-            return idx, bbox
+    if len(bbox_array) == 0:
+        return None, None
+    boxes = np.asarray([bbox[:4] for bbox in bbox_array], dtype=np.float64)
+    inside = (boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])
+    if not inside.any():
+        return None, None
+    idx = int(inside.argmax())
+    return idx, bbox_array[idx]
 
-    return None, None
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
-def extract_aitw_data():
+
+def read_image_size(img_path):
+    """
+    Read (width, height) from the PNG IHDR chunk without decoding the image.
+    Falls back to Pillow for other formats.
+    :param img_path:
+    :return: (width, height)
+    """
+    with open(img_path, 'rb') as f:
+        header = f.read(24)
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+    with Image.open(img_path) as img:
+        return img.size
+
+
+@dataclass
+class AitwEpisode:
+    """
+    Metadata of one AitW episode parsed once into typed arrays.
+    The boxes of all items are stored back to back in ui_positions (pixel x1, y1, x2, y2, padded),
+    item i owning rows offsets[i]:offsets[i + 1].
+    """
+    img_paths: List[str]
+    img_sizes: np.ndarray
+    ui_positions: np.ndarray
+    offsets: np.ndarray
+    ui_texts: List[List[str]]
+    touch_yx: np.ndarray
+
+    def item_positions(self, idx):
+        return [tuple(bbox) for bbox in self.ui_positions[self.offsets[idx]:self.offsets[idx + 1]].tolist()]
+
+    def touch_hits(self):
+        """
+        Resolve every item's touch point to the first of its boxes containing it, in one pass.
+        :return: array with the in-item box index per item, -1 if the touch hits no box
+        """
+        counts = np.diff(self.offsets)
+        item_of_box = np.repeat(np.arange(len(counts)), counts)
+        y, x = self.touch_yx[item_of_box, 0], self.touch_yx[item_of_box, 1]
+        boxes = self.ui_positions
+        inside = (boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])
+        hits = np.full(len(counts), -1, dtype=np.int64)
+        hit_boxes = np.flatnonzero(inside)
+        # hit_boxes is sorted, so the first occurrence per item is the first matching box
+        items, first = np.unique(item_of_box[hit_boxes], return_index=True)
+        hits[items] = hit_boxes[first] - self.offsets[items]
+        return hits
+
+
+def load_aitw_episode(json_data, img_dir):
+    """
+    Parse the stringified metadata of an episode once and convert all boxes in a single array pass.
+    :param json_data: items of the episode json
+    :param img_dir: directory holding the episode screenshots
+    :return: AitwEpisode
+    """
+    img_paths = [os.path.join(img_dir, os.path.basename(item['image_path'])) for item in json_data]
+    img_sizes = np.array([read_image_size(img_path) for img_path in img_paths], dtype=np.int64).reshape(-1, 2)
+    raw_positions = [json.loads(item['ui_positions']) for item in json_data]
+    counts = np.array([len(boxes) for boxes in raw_positions], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    yxhw = np.array([bbox[:4] for boxes in raw_positions for bbox in boxes]).reshape(-1, 4)
+    touch_yx = np.array([json.loads(item['result_touch_yx']) if item.get('result_touch_yx') else [np.nan, np.nan]
+                         for item in json_data], dtype=np.float64).reshape(-1, 2)
+    return AitwEpisode(
+        img_paths=img_paths,
+        img_sizes=img_sizes,
+        ui_positions=bboxes.from_yxhw(yxhw, np.repeat(img_sizes, counts, axis=0), bboxes.AITW_PAD),
+        offsets=offsets,
+        ui_texts=[json.loads(item['ui_text']) for item in json_data],
+        touch_yx=touch_yx,
+    )
+
+
+def extract_aitw_data(plan_writer=None, injection_plan=None):
+    """
+    Inject defects into the screenshots of one episode (INPUT_DIR, copied to SAVED_DIR) and record them in
+    its json.
+    :param plan_writer: DRY_RUN: write the planned defects (see uidm_main.plan_injection) to this writer
+    instead; INPUT_DIR is not copied and no screenshot is decoded or written
+    :param injection_plan: entries written by a dry run of this driver: exactly the planned screenshots get
+    their planned defects, instead of drawing them again
+    """
     input_dir = configs['INPUT_DIR']
     saved_dir = configs['SAVED_DIR']
-    copy_walk_dir(input_dir, saved_dir)
-    json_path = os.path.join(saved_dir, f'{os.path.basename(saved_dir)}.json')
+    if plan_writer is None:
+        copy_walk_dir(input_dir, saved_dir)
+    episode_dir = saved_dir if plan_writer is None else input_dir
+    json_path = os.path.join(episode_dir, f'{os.path.basename(saved_dir)}.json')
     with open(json_path, 'r', encoding='utf-8') as f:
         json_data = json.load(f)
     json_data = [{**item, "injected_defect": ""} for item in json_data]
@@ -59,38 +145,65 @@ def extract_aitw_data():
         tmp = random.choice([x for x in range(0, item_len - 1) if x not in selected])
         selected.append(tmp)
         count -= 1
+    episode = load_aitw_episode(json_data, episode_dir)
+    touch_hits = episode.touch_hits()
+    strategy_mix = Counter()
+    input_bytes = 0
+    planned = None
+    if injection_plan is not None:
+        planned = {entry["image_path"]: entry for entry in injection_plan}
     for idx, item in enumerate(json_data):
-        img_name = os.path.basename(item['image_path'])
-        img_path = os.path.join(saved_dir, img_name)
-        img_size = Image.open(img_path).size
-        ui_positions = extract_ui_positions(img_size, json.loads(item['ui_positions']))
-        ui_texts = json.loads(item['ui_text'])
-        if idx in selected:
+        img_path = episode.img_paths[idx]
+        ui_positions = episode.item_positions(idx)
+        ui_texts = episode.ui_texts[idx]
+        if planned is not None:
+            if img_path in planned:
+                uidi = inject_planned(img_path, ui_positions, ui_texts, planned[img_path])
+                item['injected_defect'] = uidi.injected_defect
+            else:
+                uidi = UIDefectInjection(img_path, ui_positions, ui_texts)
+        elif idx in selected:
             if flag:
-                y, x = json.loads(item['result_touch_yx'])
-                tmp_idx, selected_coords = check_inside(x, y, ui_positions)
-                if tmp_idx is None:
+                tmp_idx = int(touch_hits[idx])
+                if tmp_idx < 0:
                     tmp_idx = random.randint(0, len(ui_positions) - 1)
                 else:
                     flag = False
             else:
                 tmp_idx = random.randint(0, len(ui_positions) - 1)
-            uidi = ui_defect_mocker(img_path, ui_positions, ui_texts, tmp_idx)
+            if plan_writer is not None:
+                entry = plan_injection(img_path, ui_positions, ui_texts, selected=tmp_idx)
+                if entry is not None:
+                    plan_writer.write({"image_path": os.path.join(saved_dir, os.path.basename(img_path)), **entry})
+                    strategy_mix[entry["strategy"]] += 1
+                    input_bytes += os.path.getsize(img_path)
+                continue
+            uidi = ui_defect_mocker(img_path, ui_positions, ui_texts, selected=tmp_idx)
             item['injected_defect'] = uidi.injected_defect
+        elif plan_writer is not None:
+            continue
         else:
             uidi = UIDefectInjection(img_path, ui_positions, ui_texts)
         item['ui_positions'] = str(uidi.ui_positions)
         item['image_path'] = uidi.image_path
         if configs["OUTPUT_WITH_LABELED"]:
             uidi.labeled_path = os.path.join(configs['SAVED_DIR'], f"labeled_{os.path.basename(uidi.image_path)}")
-            y, x = json.loads(item['result_touch_yx'])
+            y, x = episode.touch_yx[idx]
             tmp_idx, selected_coords = check_inside(x, y, ui_positions)
-            labeled = utils.screenshot_labeled(uidi, extra=[selected_coords])
-            labeled.save(uidi.labeled_path)
+            utils.save_labeled(uidi, uidi.labeled_path, extra=[selected_coords])
             item['labeled_path'] = uidi.labeled_path
+    if plan_writer is not None:
+        print_plan_summary(os.path.basename(saved_dir), strategy_mix, input_bytes)
+        return
     with open(json_path, 'w', encoding='utf-8') as f:
         json.dump(json_data, f, indent=4)
 
 
 if __name__ == '__main__':
-    extract_aitw_data()
+    if configs.get("DRY_RUN", False):
+        with JsonArrayWriter(configs.get("INJECTION_PLAN") or "injection_plan.json", indent=2, append=False) as writer:
+            extract_aitw_data(writer)
+    else:
+        extract_aitw_data(injection_plan=load_injection_plan(keys=("image_path",)))
+    profiling.report()
+    memprofile.report()
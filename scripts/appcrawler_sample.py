@@ -1,36 +1,113 @@
 import ast
-import glob
 import json
 import os
 import random
 import shutil
+import sqlite3
 import sys
 import xml.etree.ElementTree as ET
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List
+
 from lxml import etree
 
 from config import load_config
+from uidm import bboxes, blob_store, memprofile, profiling
+from uidm.pipeline import JsonArrayWriter, rewrite_json_array
 from uidm.ui_defects import UIDefectInjection
-from uidm.utils import extract_xml, copy_walk_dir
-from uidm_main import ui_defect_mocker
+from uidm.utils import extract_xml, copy_walk_dir, iter_json_array, load_xml_tree, screenshot_size
+from uidm_main import (inject_planned, load_injection_plan, plan_injection, print_plan_summary, record_path,
+                       ui_defect_mocker)
 
 configs = load_config()
 
 
-def find_action_bbox(xml_file, xpath):
+@lru_cache(maxsize=1024)
+def compile_xpath(xpath):
+    return etree.XPath(xpath)
+
+
+def _node_bbox(nodes):
+    if nodes:
+        return bboxes.parse_bound(nodes[0].get('bounds'))
+    return ""
+
+
+def find_action_bboxes(xml_file, xpaths):
+    """
+    Resolve several testcase XPaths against one document in a single call.
+    The document is parsed once (shared through the XML tree cache) and each
+    expression is compiled once per run.
+    :param xml_file: XML dump of the screen the actions were performed on
+    :param xpaths: list of XPath expressions
+    :return: list of [x1, y1, x2, y2] (or "" if unresolved), aligned with xpaths
+    """
     if xml_file == '':
-        return ""
+        return ["" for _ in xpaths]
     try:
-        node = etree.parse(xml_file).xpath(xpath)
-        if node:
-            bounds = node[0].get('bounds')[1:-1].split("][")
-            x1, y1 = map(int, bounds[0].split(","))
-            x2, y2 = map(int, bounds[1].split(","))
-            return [x1, y1, x2, y2]
-    except etree.XPathEvalError as e:
-        print(f"UNUSABLE: {xpath}")
+        tree = load_xml_tree(xml_file)
     except Exception as e:
         print(f"XPATH ERROR: {e}")
-    return ""
+        return ["" for _ in xpaths]
+    action_bboxes = []
+    for xpath in xpaths:
+        bbox = ""
+        try:
+            bbox = _node_bbox(compile_xpath(xpath)(tree))
+        except etree.XPathError as e:
+            print(f"UNUSABLE: {xpath}")
+        except Exception as e:
+            print(f"XPATH ERROR: {e}")
+        action_bboxes.append(bbox)
+    return action_bboxes
+
+
+def find_action_bbox(xml_file, xpath):
+    return find_action_bboxes(xml_file, [xpath])[0]
+
+
+@dataclass
+class CrawlDirIndex:
+    """
+    One-pass index of an AppCrawler dump directory.
+    pngs/xmls map the clickedIndex prefix of a file name (``<clickedIndex>_...``) to its paths,
+    in directory order, so per-testcase lookups are O(1) instead of a scan over every file.
+    """
+    xml_files: List[str] = field(default_factory=list)
+    pngs: Dict[str, List[str]] = field(default_factory=lambda: defaultdict(list))
+    xmls: Dict[str, List[str]] = field(default_factory=lambda: defaultdict(list))
+
+
+_crawl_dir_indices: Dict[str, CrawlDirIndex] = {}
+
+
+def index_crawl_dir(input_dir):
+    """
+    Build (once per directory) the clickedIndex -> png/xml index with a single os.scandir pass.
+    The index is cached, so it is shared by every testcase and package reading the same dump.
+    :param input_dir: AppCrawler output directory
+    :return: CrawlDirIndex
+    """
+    key = os.path.abspath(input_dir)
+    if key in _crawl_dir_indices:
+        return _crawl_dir_indices[key]
+    index = CrawlDirIndex()
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            path = f'{input_dir}/{entry.name}'
+            prefix = entry.name.split('_')[0]
+            if entry.name.endswith('.png'):
+                index.pngs[prefix].append(path)
+            elif entry.name.endswith('.xml'):
+                index.xml_files.append(path)
+                index.xmls[prefix].append(path)
+    _crawl_dir_indices[key] = index
+    return index
 
 
 def get_subdirectories(directory):
@@ -38,10 +115,40 @@ def get_subdirectories(directory):
     return subdirectories
 
 
+_appinfo_indices: Dict[str, sqlite3.Connection] = {}
+
+
+def load_appinfo_index(json_path):
+    """
+    Open the on-disk app_id index of an app metadata catalog (e.g. Google_Play_Top_200.json).
+    The index is a SQLite file next to the catalog, built by streaming the catalog once and
+    rebuilt only when the catalog is newer than it. Lookups never load the catalog into memory.
+    :param json_path: path of the JSON catalog
+    :return: sqlite3.Connection
+    """
+    index_path = f'{os.path.splitext(json_path)[0]}.index.sqlite'
+    if index_path in _appinfo_indices:
+        return _appinfo_indices[index_path]
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(json_path):
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        with sqlite3.connect(tmp_path) as conn:
+            conn.execute('DROP TABLE IF EXISTS apps')
+            conn.execute('CREATE TABLE apps (app_id TEXT, data TEXT)')
+            conn.executemany('INSERT INTO apps VALUES (?, ?)',
+                             ((app.get('app_id'), json.dumps(app, ensure_ascii=False))
+                              for app in iter_json_array(json_path)))
+            conn.execute('CREATE INDEX apps_app_id ON apps (app_id)')
+        conn.close()
+        os.replace(tmp_path, index_path)
+    conn = sqlite3.connect(index_path)
+    _appinfo_indices[index_path] = conn
+    return conn
+
+
 def fileter_appinfo(json_path, package_name, saved_path):
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    selected_app = [app for app in data if app['app_id'] == package_name]
+    rows = load_appinfo_index(json_path).execute(
+        'SELECT data FROM apps WHERE app_id = ? ORDER BY rowid', (package_name,))
+    selected_app = [json.loads(data) for data, in rows]
     if not os.path.exists(saved_path):
         os.makedirs(saved_path)
     with open(f'{saved_path}/{package_name}.json', 'w') as f:
@@ -72,8 +179,8 @@ def extract_testcases_xml(xml_file):
 
 def pre_processing(input_dir, package_name):
     testcases_match = f'TEST-{package_name}'
-    xml_files = glob.glob(f'{input_dir}/*.xml', recursive=True)
-    filtered_xml = [xml for xml in xml_files if testcases_match in xml]
+    crawl_index = index_crawl_dir(input_dir)
+    filtered_xml = [xml for xml in crawl_index.xml_files if testcases_match in xml]
     fileter_appinfo('./Google_Play_Top_200.json', package_name, f"{configs['SAVED_DIR']}/{package_name}")
     for xml_file in filtered_xml:
         testcases = extract_testcases_xml(xml_file)
@@ -83,34 +190,38 @@ def pre_processing(input_dir, package_name):
         saved_dir = f"{configs['SAVED_DIR']}/{classname.split('.')[-1]}"
         if not os.path.exists(saved_dir):
             os.makedirs(saved_dir)
-        imgs = glob.glob(f'{input_dir}/*.png', recursive=True)
+        action_xmls = defaultdict(list)
         for testcase in testcases:
             testcase['imgs_path'] = []
             clickedIndex = int(testcase['clickedIndex'])
-            f_imgs = [img for img in imgs if os.path.basename(img).split('_')[0] == str(clickedIndex)]
+            f_imgs = crawl_index.pngs.get(str(clickedIndex), [])
             if len(f_imgs) < 2:
                 continue
             fir_img, sec_img = f_imgs[0], f_imgs[1]
             if 'clicked' in fir_img:
                 fir_img, sec_img = sec_img, fir_img
-            shutil.copy(fir_img, f'{saved_dir}/{clickedIndex}_0.png')
+            blob_store.copy_file(fir_img, f'{saved_dir}/{clickedIndex}_0.png')
             testcase['imgs_path'].append(f'{saved_dir}/{clickedIndex}_0.png')
-            shutil.copy(sec_img, f'{saved_dir}/{clickedIndex}_1.png')
+            blob_store.copy_file(sec_img, f'{saved_dir}/{clickedIndex}_1.png')
             testcase['imgs_path'].append(f'{saved_dir}/{clickedIndex}_1.png')
-            sec_xml = [xml for xml in xml_files if os.path.basename(xml).split('_')[0] == str(clickedIndex)][0]
+            sec_xml = crawl_index.xmls[str(clickedIndex)][0]
             fir_xml = ''
             if clickedIndex - 1 >= 0 and clickedIndex - 1 != 1:
-                fir_xml = [xml for xml in xml_files if os.path.basename(xml).split('_')[0] == str(clickedIndex - 1)]
+                fir_xml = crawl_index.xmls.get(str(clickedIndex - 1), [])
                 if fir_xml:
                     fir_xml = fir_xml[0]
                     shutil.copy(fir_xml, f'{saved_dir}/{clickedIndex}_0.xml')
             shutil.copy(sec_xml, f'{saved_dir}/{clickedIndex}_1.xml')
-            testcase['action_bbox'] = str(find_action_bbox(fir_xml, testcase['xpath']))
+            action_xmls[fir_xml or ''].append(testcase)
             # el_list_before = extract_xml(fir_xml)
             # el_list_after = extract_xml(sec_xml)
             # testcase['ui_positions'] = [str([el.bbox for el in el_list_before]), str([el.bbox for el in el_list_after])]
             # testcase['ui_text'] = [str([el.text for el in el_list_before]), str([el.text for el in el_list_after])]
             # testcase['ui_type'] = [str([el.type for el in el_list_before]), str([el.type for el in el_list_after])]
+        for fir_xml, xml_testcases in action_xmls.items():
+            action_bboxes = find_action_bboxes(fir_xml, [testcase['xpath'] for testcase in xml_testcases])
+            for testcase, bbox in zip(xml_testcases, action_bboxes):
+                testcase['action_bbox'] = str(bbox)
 
         with open(f'{saved_dir}/{classname}.json', 'w') as f:
             json.dump(testcases, f, indent=4, ensure_ascii=False)
@@ -120,7 +231,8 @@ import json
 
 def re_processing(ori_dir, clickIndex, item):
     def process_xml(xml_path):
-        elements = extract_xml(xml_path) if xml_path else []
+        # the screenshot pre_processing copied next to the XML, to clip the boxes to
+        elements = extract_xml(xml_path, screenshot_size(xml_path.replace(".xml", ".png"))) if xml_path else []
         return {
             "ui_positions": json.dumps([el.bbox for el in elements]),
             "ui_text": json.dumps([el.text for el in elements]),
@@ -149,48 +261,130 @@ def extract_appcrawler_data(input_dir, package_name):
     pass
 
 
-def uimocker():
+def _crawler_target(item, ori_path, sub):
+    """
+    Reprocess one testcase of a crawler JSON and pick the screenshot to inject defects into: the one after
+    the action, or the one before it if the screen after has fewer than two elements.
+    :return: (item, selected screenshot, ui_positions, ui_texts), or None if the testcase is filtered out
+    """
+    item = {**item, "ui_type": "", "injected_defect": ""}
+    if item['clickedIndex'] == '0':
+        return None
+    re_processing(ori_path, item['clickedIndex'], item)
+    print(f"#{item['clickedIndex']} Reprocessed {item['ui_type']} for {sub}")
+    if len(item['imgs_path']) < 2 or item['action'] == "":
+        return None
+    selected = 1
+    item['ui_positions'] = [ui.replace('(', '[').replace(')', ']') for ui in item['ui_positions']]
+    ui_positions = json.loads(item['ui_positions'][1])
+    ui_texts = ast.literal_eval(item['ui_text'][1])
+    if len(ui_positions) < 2:
+        selected = 0
+        ui_positions = json.loads(item['ui_positions'][0])
+        ui_texts = ast.literal_eval(item['ui_text'][0])
+    return item, selected, ui_positions, ui_texts
+
+
+def _saved_path(img_path):
+    return img_path.replace('original_cs_data', 'Defective_Close_Source')
+
+
+def inject_crawler_item(item, ori_path, sub, records=None, planned=None):
+    """
+    Reprocess one testcase of a crawler JSON and inject defects into its screenshot.
+    :param records: JsonArrayWriter of the run records (JSON_RECORD), see uidm_main.ui_defect_mocker
+    :param planned: plan entries of a dry run of this driver by (sub, clickedIndex): the testcase gets its
+    planned defects, or none if it is not in the plan
+    :return: the updated item, or None if the testcase is filtered out
+    """
+    target = _crawler_target(item, ori_path, sub)
+    if target is None:
+        return None
+    item, selected, ui_positions, ui_texts = target
+    item['imgs_path'] = [_saved_path(img_path) for img_path in item['imgs_path']]
+    if planned is not None:
+        entry = planned.get((sub, item['clickedIndex']))
+        if entry is None:
+            return item
+        uidi = inject_planned(entry["image_path"], ui_positions, ui_texts, entry, record=records)
+    else:
+        uidi = ui_defect_mocker(item['imgs_path'][selected], ui_positions, ui_texts, difficulty='medium',
+                                selected=selected, record=records)
+    item['ui_positions'][selected] = json.dumps(uidi.ui_positions)
+    item['injected_defect'] = uidi.injected_defect
+    return item
+
+
+def plan_crawler_item(item, ori_path, sub):
+    """
+    Dry-run counterpart of inject_crawler_item: plan the defects of one testcase on its original screenshot.
+    :return: plan entry (see uidm_main.plan_injection) with the "image_path" to inject into, or None
+    """
+    target = _crawler_target(item, ori_path, sub)
+    if target is None:
+        return None
+    item, selected, ui_positions, ui_texts = target
+    # the screenshot as copied into ori_path by pre_processing, next to the XML re_processing read
+    ori_img = f"{ori_path}/{os.path.basename(item['imgs_path'][selected])}"
+    entry = plan_injection(ori_img, ui_positions, ui_texts, difficulty='medium', selected=selected)
+    if entry is None:
+        return None
+    return {"image_path": _saved_path(item['imgs_path'][selected]), "clickedIndex": item['clickedIndex'],
+            "source_path": ori_img, **entry}
+
+
+def plan_uimocker(plan_path):
+    """
+    DRY_RUN: plan the defects of every testcase of INPUT_DIR and write them to plan_path, without copying
+    INPUT_DIR to SAVED_DIR or touching a screenshot.
+    """
+    input_dir = configs['INPUT_DIR']
+    package_name = configs['SAVED_DIR'].split('/')[-1]
+    with JsonArrayWriter(plan_path, indent=2, append=False) as writer:
+        for sub in get_subdirectories(input_dir):
+            strategy_mix = Counter()
+            input_bytes = 0
+            ori_path = f'{input_dir}/{sub}'
+            for item in iter_json_array(f'{ori_path}/{package_name}.{sub}.json'):
+                entry = plan_crawler_item(item, ori_path, sub)
+                if entry is None:
+                    continue
+                writer.write({"sub": sub, **entry})
+                strategy_mix[entry["strategy"]] += 1
+                input_bytes += os.path.getsize(entry["source_path"])
+            print_plan_summary(sub, strategy_mix, input_bytes)
+
+
+def uimocker(injection_plan=None):
+    """
+    Copy INPUT_DIR to SAVED_DIR and inject defects into the testcases of every subdirectory.
+    :param injection_plan: entries written by plan_uimocker, applied exactly as planned instead of drawing
+    the defects again
+    """
+    planned = None
+    if injection_plan is not None:
+        planned = {(entry["sub"], entry["clickedIndex"]): entry for entry in injection_plan}
     input_dir = configs['INPUT_DIR']
     saved_dir = configs['SAVED_DIR']
     copy_walk_dir(input_dir, saved_dir)
     root_dir, package_name = saved_dir.split('/')[-2:]
     subdirs = get_subdirectories(saved_dir)
-    for sub in subdirs:
-        if sub == '':
-            continue
-        subpath = f'{saved_dir}/{sub}'
-        ori_path = f'{input_dir}/{sub}'
-        with open(f'{subpath}/{package_name}.{sub}.json', 'r') as f:
-            json_data = json.load(f)
-            json_data = [{**item, "ui_type": ""} for item in json_data]
-            json_data = [{**item, "injected_defect": ""} for item in json_data]
-        for item in json_data:
-            if item['clickedIndex'] == '0':
-                json_data.remove(item)
-                continue
-            re_processing(ori_path, item['clickedIndex'], item)
-            print(f"#{item['clickedIndex']} Reprocessed {item['ui_type']} for {sub}")
-            item['imgs_path'] = [img_path.replace('original_cs_data', 'Defective_Close_Source') for img_path in
-                                 item['imgs_path']]
-            if len(item['imgs_path']) < 2 or item['action'] == "":
-                json_data.remove(item)
+    with JsonArrayWriter(record_path()) if configs["JSON_RECORD"] else nullcontext() as records:
+        for sub in subdirs:
+            if sub == '':
                 continue
-            selected = 1
-            item['ui_positions'] = [ui.replace('(', '[').replace(')', ']') for ui in item['ui_positions']]
-            ui_positions = json.loads(item['ui_positions'][1])
-            ui_texts = ast.literal_eval(item['ui_text'][1])
-            if len(ui_positions) < 2:
-                selected = 0
-                ui_positions = json.loads(item['ui_positions'][0])
-                ui_texts = ast.literal_eval(item['ui_text'][0])
-            uidi = ui_defect_mocker(item['imgs_path'][selected], ui_positions, ui_texts, difficulty='medium', selected=selected)
-            item['ui_positions'][selected] = json.dumps(uidi.ui_positions)
-            item['injected_defect'] = uidi.injected_defect
-
-        with open(f'{subpath}/{package_name}.{sub}.json', 'w') as f:
-            json.dump(json_data, f, indent=4, ensure_ascii=False)
-        print(f"Injected Defects for {sub}")
+            subpath = f'{saved_dir}/{sub}'
+            ori_path = f'{input_dir}/{sub}'
+            rewrite_json_array(f'{subpath}/{package_name}.{sub}.json',
+                               lambda item: inject_crawler_item(item, ori_path, sub, records, planned),
+                               ensure_ascii=False)
+            print(f"Injected Defects for {sub}")
 
 
 if __name__ == '__main__':
-    uimocker()
+    if configs.get("DRY_RUN", False):
+        plan_uimocker(configs.get("INJECTION_PLAN") or "injection_plan.json")
+    else:
+        uimocker(load_injection_plan(keys=("sub", "clickedIndex", "image_path")))
+    profiling.report()
+    memprofile.report()
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def resources(monkeypatch, tmp_path):
+    """Absolute font and resource paths, and a scratch working directory for the patches strategies save."""
+    from uidm import ui_defects, utils
+    for configs in (ui_defects.configs, utils.configs):
+        monkeypatch.setitem(configs, "FONT_PATH", os.path.join(ROOT, "resources", "Roboto-Regular.ttf"))
+        monkeypatch.setitem(configs, "RESOURCE_DIR", os.path.join(ROOT, "resources"))
+    monkeypatch.chdir(tmp_path)
+    # el_misaligned saves its patch without creating the directory, which earlier strategies of a run have made
+    (tmp_path / "tmp").mkdir()
@@ -0,0 +1,87 @@
+import random
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import uidm_main
+from uidm import array_ops, ui_defects
+
+ELEMENT_STRATEGIES = ["CONTENT_ERROR", "CONTENT_REPEAT", "EL_OVERLAPPING", "EL_SCALING", "EL_MISSING_BLANK",
+                      "EL_MISSING_BROKEN_IMG", "EL_MISALIGNED", "UNEVEN_SPACE"]
+
+
+def _frame(mode, seed, size=(360, 640)):
+    """Screenshot-like frame: a flat background with random colored blocks, converted to mode."""
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, (245, 245, 245))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle((x, y, x + rng.randrange(8, 120), y + rng.randrange(8, 60)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image.convert(mode)
+
+
+def _random_box(rng, size):
+    """Box of any size, partly or entirely off the frame, with fractional coordinates now and then."""
+    w, h = size
+    x1, y1 = rng.uniform(-40, w + 10), rng.uniform(-40, h + 10)
+    box = [x1, y1, x1 + rng.uniform(0, 120), y1 + rng.uniform(0, 80)]
+    return box if rng.random() < 0.3 else [int(v) for v in box]
+
+
+@pytest.mark.parametrize("mode", array_ops.SUPPORTED_MODES)
+@pytest.mark.parametrize("seed", range(5))
+def test_primitives_match_pillow(mode, seed):
+    rng = random.Random(seed)
+    image = _frame(mode, seed)
+    arr = array_ops.image_to_array(image)
+    for _ in range(50):
+        box = _random_box(rng, image.size)
+        assert array_ops.crop(arr, box).tobytes() == image.crop(box).tobytes()
+
+        color = tuple(rng.randrange(256) for _ in range(3))
+        ImageDraw.Draw(image).rectangle(box, fill=color)
+        array_ops.fill_rect(arr, box, color)
+        assert arr.tobytes() == image.tobytes()
+
+        src_box = [int(v) for v in _random_box(rng, image.size)]
+        patch = image.crop(src_box)
+        xy = (rng.randrange(-60, image.width), rng.randrange(-60, image.height))
+        array_ops.paste(arr, array_ops.image_to_array(patch), xy)
+        image.paste(patch, xy)
+        assert arr.tobytes() == image.tobytes()
+
+        if patch.width and patch.height:
+            size = (rng.randrange(1, 150), rng.randrange(1, 90))
+            resized = array_ops.resize(array_ops.image_to_array(patch), size, mode)
+            assert resized.tobytes() == patch.resize(size).tobytes()
+            colors = patch.convert("RGB").getcolors(patch.width * patch.height)
+            counts = [count for count, _ in colors]
+            assert array_ops.dominant_color(array_ops.image_to_array(patch)) in [
+                c for count, c in colors if count == max(counts)]
+
+
+def _inject(tmp_path, monkeypatch, backend, mode, strategy, seed):
+    monkeypatch.setitem(ui_defects.configs, "RENDER_BACKEND", backend)
+    path = str(tmp_path / f"{backend}.png")
+    _frame(mode, seed).save(path)
+    positions = [[x, y, x + 150, y + 40] for y in range(20, 600, 60) for x in (10, 190)]
+    random.seed(seed)
+    uidi = uidm_main.ui_defect_mocker(path, positions, ["Settings"] * len(positions), strategy=strategy)
+    with Image.open(path) as injected:
+        return injected.mode, injected.tobytes(), injected.getpalette(), uidi.ui_positions
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "P"])
+@pytest.mark.parametrize("strategy", ELEMENT_STRATEGIES)
+@pytest.mark.parametrize("seed", range(3))
+def test_numpy_backend_matches_pillow(tmp_path, monkeypatch, mode, strategy, seed):
+    """RENDER_BACKEND numpy gives the same screenshots as pillow (P frames take the Pillow path in both)."""
+    monkeypatch.setitem(uidm_main.configs, "OUTPUT_WITH_LABELED", False)
+    monkeypatch.setitem(uidm_main.configs, "VERIFY_INJECTION", False)
+    pillow = _inject(tmp_path, monkeypatch, "pillow", mode, strategy, seed)
+    numpy_ = _inject(tmp_path, monkeypatch, "numpy", mode, strategy, seed)
+    assert pillow[0] == numpy_[0] == mode
+    assert numpy_ == pillow
@@ -0,0 +1,20 @@
+from uidm import blob_store, utils
+from uidm.ui_defects import _link_frame
+
+
+def test_rerun_over_linked_frames(tmp_path, monkeypatch):
+    """A second copy into SAVED_DIR replaces linked frames instead of writing through the shared file."""
+    monkeypatch.setitem(blob_store.configs, "BLOB_STORE_DIR", "")
+    source, saved = tmp_path / "in", tmp_path / "saved"
+    source.mkdir()
+    (source / "a_0.png").write_bytes(b"FRAME0")
+    (source / "a_1.png").write_bytes(b"FRAME1")
+    utils.copy_walk_dir(str(source), str(saved))
+    # OPERATION_NO_RESPONSE: the second frame becomes a link to the first
+    _link_frame(str(saved / "a_0.png"), str(saved / "a_1.png"))
+    assert (saved / "a_1.png").read_bytes() == b"FRAME0"
+
+    utils.copy_walk_dir(str(source), str(saved))
+    assert (saved / "a_0.png").read_bytes() == b"FRAME0"
+    assert (saved / "a_1.png").read_bytes() == b"FRAME1"
+    assert (source / "a_0.png").read_bytes() == b"FRAME0"
@@ -0,0 +1,45 @@
+from collections import Counter
+
+import pytest
+from PIL import Image
+
+import uidm_main
+from uidm import schedule
+from uidm.ui_defects import eligible_elements
+
+SCATTERED = [(10, 10, 100, 50), (200, 300, 260, 330)]
+COLUMN = [(10, 10, 100, 50), (10, 100, 100, 150)]
+ROW = [(10, 10, 100, 50), (150, 10, 260, 50)]
+
+
+@pytest.mark.parametrize("positions, misaligned, uneven", [(SCATTERED, False, False), (COLUMN, True, True),
+                                                           (ROW, True, False)])
+def test_layout_strategies_need_their_group(positions, misaligned, uneven):
+    texts = ["a", "b"]
+    assert eligible_elements(positions, texts, "EL_MISALIGNED", (400, 400)).any() == misaligned
+    assert eligible_elements(positions, texts, "UNEVEN_SPACE", (400, 400)).any() == uneven
+    assert eligible_elements(positions, texts, "EL_SCALING", (400, 400)).all()
+
+
+@pytest.mark.parametrize("strategy", ["EL_MISALIGNED", "UNEVEN_SPACE"])
+def test_no_layout_defect_recorded_without_group(tmp_path, monkeypatch, strategy):
+    monkeypatch.setitem(uidm_main.configs, "OUTPUT_WITH_LABELED", False)
+    monkeypatch.setitem(uidm_main.configs, "VERIFY_INJECTION", False)
+    path = str(tmp_path / "screen.png")
+    Image.new("RGB", (400, 400), (240, 240, 240)).save(path)
+    uidi = uidm_main.ui_defect_mocker(path, [list(box) for box in SCATTERED], ["a", "b"], strategy=strategy)
+    assert not uidi.injected_defect
+
+
+def test_schedule_skips_layout_strategies_without_group(monkeypatch):
+    strategies = ["EL_MISALIGNED", "UNEVEN_SPACE", "EL_SCALING"]
+    monkeypatch.setitem(schedule.configs, "STRATEGY", strategies)
+    monkeypatch.setitem(schedule.configs, "STRATEGY_QUOTAS", {})
+    screens = {f"scattered_{i}.png": SCATTERED for i in range(2)}
+    screens.update({f"column_{i}.png": COLUMN for i in range(10)})
+    eligibility = {name: schedule.eligible_strategies(positions, ["a", "b"], (400, 400))
+                   for name, positions in screens.items()}
+    assert eligibility["scattered_0.png"] == ["EL_SCALING"]
+    plan = schedule.plan_schedule(eligibility)
+    assert all(plan[name] == "EL_SCALING" for name in screens if name.startswith("scattered"))
+    assert sorted(Counter(plan.values()).values()) == [4, 4, 4]
@@ -0,0 +1,22 @@
+from uidm import utils
+
+XML = """<?xml version="1.0" encoding="UTF-8"?>
+<hierarchy>
+  <node index="0" class="android.widget.FrameLayout" bounds="[0,0][360,640]">
+    <node index="0" class="android.widget.Button" bounds="[10,10][110,60]" clickable="true" text="on screen"/>
+    <node index="1" class="android.widget.Button" bounds="[300,500][460,560]" clickable="true" text="past the edge"/>
+    <node index="2" class="android.widget.Button" bounds="[500,900][600,950]" clickable="true" text="off screen"/>
+    <node index="3" class="android.widget.Button" bounds="[40,300][40,340]" clickable="true" text="empty"/>
+  </node>
+</hierarchy>
+"""
+
+
+def test_boxes_are_clipped_to_the_screenshot(tmp_path):
+    xml_path = tmp_path / "screen.xml"
+    xml_path.write_text(XML)
+    assert [el.text for el in utils.extract_xml(str(xml_path))] == ["on screen", "past the edge", "off screen",
+                                                                     "empty"]
+    elements = utils.extract_xml(str(xml_path), (360, 640))
+    assert [(el.text, el.bbox) for el in elements] == [("on screen", [10, 10, 110, 60]),
+                                                      ("past the edge", [300, 500, 360, 560])]
@@ -0,0 +1,19 @@
+from PIL import Image
+
+import uidm_main
+from uidm import frames
+
+
+def test_prefetch_falls_back_when_no_slot_frees(tmp_path, monkeypatch):
+    """A slot never released (its worker died) makes prefetch leave decoding to the worker instead of hanging."""
+    monkeypatch.setitem(uidm_main.configs, "SHARED_FRAME_TIMEOUT", 0.1)
+    path = str(tmp_path / "screen.png")
+    image = Image.new("RGB", (40, 30), (10, 20, 30))
+    image.save(path)
+    positions = [[0, 0, 10, 10]]
+    monkeypatch.setattr(uidm_main, "_prefetch_screenshot",
+                        lambda item: (path, positions, ["a"], "EL_SCALING", None))
+    with frames.FramePool(1, 1 << 16) as pool:
+        assert pool.put(image, positions) is not None
+        prefetched = uidm_main._prefetch_shared(pool, "screen.png")
+    assert prefetched == (path, positions, ["a"], "EL_SCALING", None, None)
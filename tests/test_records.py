@@ -0,0 +1,30 @@
+import json
+
+from uidm import records
+
+
+def _labeled(prefix):
+    return f'data/labeled_synthetic-data/{prefix}'
+
+
+def test_named_rewrite_is_applied_once(tmp_path):
+    json_path = tmp_path / "app.json"
+    json_path.write_text(json.dumps([{"image_path": "AitW/a/0.png", "ui_positions": "[(0, 0, 4, 4)]"}]))
+    path = records.ensure_records(str(json_path))
+    assert records.rewrite_prefixes(path, _labeled, name="labeled")
+    assert not records.rewrite_prefixes(path, _labeled, name="labeled")
+    # an up-to-date records file is kept, so a second run finds the rewrite already applied
+    assert records.ensure_records(str(json_path)) == path
+    assert not records.rewrite_prefixes(path, _labeled, name="labeled")
+    assert [item["image_path"] for item in records.iter_records(path)] == ["data/labeled_synthetic-data/AitW/a/0.png"]
+    assert records.read_header(path)["rewrites"] == ["labeled"]
+
+
+def test_unnamed_rewrite_is_always_applied(tmp_path):
+    json_path = tmp_path / "app.json"
+    json_path.write_text(json.dumps([{"imgs_path": ["./a/0.png"]}]))
+    path = records.convert_json(str(json_path))
+    records.rewrite_prefixes(path, _labeled)
+    records.rewrite_prefixes(path, _labeled)
+    assert next(records.iter_records(path))["imgs_path"] == [_labeled(_labeled("./a/")) + "0.png"]
+    assert "rewrites" not in records.read_header(path)
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from uidm import ui_defects
+from uidm.ui_defects import UIDefectInjection, draw_text, el_text_batch, load_font, strategies
+
+TEXT_FILL = (57, 57, 57)
+
+
+def _base(mode):
+    image = Image.new("RGB", (160, 48), (200, 220, 240))
+    ImageDraw.Draw(image).rectangle((40, 10, 120, 40), fill=(30, 120, 200))
+    return image.convert(mode)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "P"])
+@pytest.mark.parametrize("xy", [(5, 5), (-3, 12), (7.5, 4)])
+def test_draw_text_matches_imagedraw(mode, xy):
+    expected, actual = _base(mode), _base(mode)
+    font = load_font(ui_defects.configs["FONT_PATH"], 18)
+    ImageDraw.Draw(expected).text(xy, "Hello gy", fill=TEXT_FILL, font=font)
+    draw_text(actual, xy, "Hello gy", TEXT_FILL, 18)
+    assert actual.tobytes() == expected.tobytes()
+    assert actual.getpalette() == expected.getpalette()
+
+
+def test_draw_text_single_band():
+    expected, actual = _base("L"), _base("L")
+    font = load_font(ui_defects.configs["FONT_PATH"], 18)
+    ImageDraw.Draw(expected).text((5, 5), "Hello", fill=57, font=font)
+    draw_text(actual, (5, 5), "Hello", TEXT_FILL, 18)
+    assert actual.tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "P", "L"])
+@pytest.mark.parametrize("strategy", ["CONTENT_REPEAT", "CONTENT_ERROR"])
+def test_text_batch_matches_per_element(tmp_path, mode, strategy):
+    positions = [(10, 10, 150, 50), (10, 80, 150, 120), (10, 150, 150, 190)]
+    texts = ["Sign in", "Settings", "Cancel"]
+    paths = []
+    for batched in (False, True):
+        path = str(tmp_path / f"{mode}_{strategy}_{batched}.png")
+        Image.new("RGB", (200, 220), (245, 245, 245)).convert(mode).save(path)
+        uidi = UIDefectInjection(path, list(positions), texts, alignment_el={})
+        random.seed(0)
+        if batched:
+            el_text_batch(uidi, strategy, [0, 1, 2])
+        else:
+            for idx in range(3):
+                uidi.selected = idx
+                strategies[strategy](uidi)
+        paths.append(path)
+    with Image.open(paths[0]) as per_element, Image.open(paths[1]) as batch:
+        assert batch.mode == mode
+        assert batch.tobytes() == per_element.tobytes()
@@ -0,0 +1,119 @@
+import operator
+
+import numpy as np
+from PIL import Image
+
+SUPPORTED_MODES = ("RGB", "RGBA")
+
+
+def image_to_array(image):
+    """
+    Copy a decoded image into a writable (height, width, channels) uint8 array.
+    """
+    return np.array(image, dtype=np.uint8)
+
+
+def array_to_image(arr, mode):
+    """
+    Wrap an array as a PIL Image without copying; the image shares the array's memory.
+    """
+    arr = np.ascontiguousarray(arr)
+    height, width = arr.shape[:2]
+    return Image.frombuffer(mode, (width, height), arr, "raw", mode, 0, 1)
+
+
+def crop(arr, box):
+    """
+    Same as Image.crop: coordinates are rounded and the area outside the frame is zero-filled.
+    :return: a new array
+    """
+    x1, y1, x2, y2 = map(int, map(round, box))
+    if x2 < x1:
+        raise ValueError("Coordinate 'right' is less than 'left'")
+    if y2 < y1:
+        raise ValueError("Coordinate 'lower' is less than 'upper'")
+    height, width = arr.shape[:2]
+    out = np.zeros((y2 - y1, x2 - x1) + arr.shape[2:], dtype=arr.dtype)
+    sx1, sy1, sx2, sy2 = max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+    if sx1 < sx2 and sy1 < sy2:
+        out[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1] = arr[sy1:sy2, sx1:sx2]
+    return out
+
+
+def fill_rect(arr, box, color):
+    """
+    Same as ImageDraw.rectangle(box, fill=color): coordinates are truncated and both corners are inclusive.
+    An RGB color on an RGBA frame is drawn opaque. Fills in place.
+    """
+    x1, y1, x2, y2 = box
+    if x2 < x1:
+        raise ValueError("x1 must be greater than or equal to x0")
+    if y2 < y1:
+        raise ValueError("y1 must be greater than or equal to y0")
+    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+    x1, y1 = max(x1, 0), max(y1, 0)
+    if x2 < 0 or y2 < 0:
+        return
+    if arr.shape[2] == 4 and len(color) == 3:
+        color = tuple(color) + (255,)
+    arr[y1:y2 + 1, x1:x2 + 1] = color
+
+
+def paste(arr, src, xy):
+    """
+    Same as Image.paste(src, xy) without a mask: src is copied at xy and clipped to the frame. Pastes in place.
+    """
+    x, y = operator.index(xy[0]), operator.index(xy[1])
+    src_h, src_w = src.shape[:2]
+    height, width = arr.shape[:2]
+    dx1, dy1, dx2, dy2 = max(x, 0), max(y, 0), min(x + src_w, width), min(y + src_h, height)
+    if dx1 >= dx2 or dy1 >= dy2:
+        return
+    arr[dy1:dy2, dx1:dx2] = src[dy1 - y:dy2 - y, dx1 - x:dx2 - x]
+
+
+def resize(arr, size, mode):
+    """
+    Resize a (small) element crop with Pillow's resampling on a zero-copy view of the array,
+    so the result matches Image.resize bit for bit.
+    """
+    return image_to_array(array_to_image(arr, mode).resize(size))
+
+
+def _pack_rgb(arr):
+    rgb = arr[..., :3]
+    return (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+
+
+def _most_common(packed):
+    values, first, counts = np.unique(packed.ravel(), return_index=True, return_counts=True)
+    candidates = np.flatnonzero(counts == counts.max())
+    value = int(values[candidates[np.argmin(first[candidates])]])
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+
+
+def dominant_color(arr):
+    """
+    Most frequent RGB color of an element crop, vectorized.
+    Ties are broken by first occurrence in row-major order, as collections.Counter.most_common does.
+    """
+    return _most_common(_pack_rgb(arr))
+
+
+def dominant_colors(frame, boxes):
+    """
+    Dominant colors of several elements of one frame, packing the frame's pixels only once.
+    Boxes are rounded like Image.crop and clipped to the frame.
+    :return: list of RGB tuples, None for boxes with no visible pixels
+    """
+    packed = _pack_rgb(frame)
+    height, width = packed.shape
+    colors = []
+    for box in boxes:
+        x1, y1, x2, y2 = map(int, map(round, box))
+        x1, y1, x2, y2 = max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+        if x1 >= x2 or y1 >= y2:
+            colors.append(None)
+            continue
+        colors.append(_most_common(packed[y1:y2, x1:x2]))
+    return colors
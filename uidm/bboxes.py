@@ -0,0 +1,117 @@
+import re
+
+import numpy as np
+
+# Android bounds attribute, "[x1,y1][x2,y2]"
+_BOUNDS = re.compile(r'\[\s*(-?\d+)\s*,\s*(-?\d+)\s*\]\[\s*(-?\d+)\s*,\s*(-?\d+)\s*\]')
+# padding (dx, dy) AitW boxes get after clamping
+AITW_PAD = (5, 3)
+
+
+def as_boxes(ui_positions, dtype=None):
+    """
+    Element boxes (x1, y1, x2, y2, ...) as an (n, 4) array. Integer boxes (from XML) stay integers unless a
+    dtype is given, anything else is float64.
+    """
+    boxes = np.asarray([position[:4] for position in ui_positions]).reshape(-1, 4)
+    if dtype is None:
+        dtype = np.int64 if boxes.dtype.kind in 'iu' else np.float64
+    return boxes.astype(dtype)
+
+
+def parse_bounds(bounds):
+    """
+    Parse Android bounds strings in one pass.
+    :param bounds: list of "[x1,y1][x2,y2]" strings
+    :return: (n, 4) int64 array of x1, y1, x2, y2
+    """
+    if not bounds:
+        return np.zeros((0, 4), dtype=np.int64)
+    values = _BOUNDS.findall('\n'.join(bounds))
+    if len(values) != len(bounds):
+        raise ValueError(f"malformed bounds in {bounds!r}")
+    return np.asarray(values).astype(np.int64).reshape(-1, 4)
+
+
+def parse_bound(bounds):
+    """Parse one Android bounds string to [x1, y1, x2, y2]."""
+    match = _BOUNDS.fullmatch(bounds.strip())
+    if match is None:
+        raise ValueError(f"malformed bounds {bounds!r}")
+    return [int(v) for v in match.groups()]
+
+
+def from_yxhw(yxhw, img_sizes, pad=(0, 0)):
+    """
+    Convert (y, x, height, width) boxes to (x1, y1, x2, y2): clamp to the image, then pad.
+    As AitW has always done it, the far edge is clamped to no less than the padded near edge, and the
+    padding may take a box past the image border.
+    :param yxhw: (n, 4) boxes
+    :param img_sizes: (width, height) of the image, or an (n, 2) array of one per box
+    :param pad: (dx, dy) subtracted from x1, y1 and added to x2, y2
+    :return: (n, 4) array (integers stay integers)
+    """
+    yxhw = np.asarray(yxhw).reshape(-1, 4)
+    img_sizes = np.asarray(img_sizes).reshape(-1, 2)
+    w, h = img_sizes[:, 0], img_sizes[:, 1]
+    dx, dy = pad
+    y1, x1, height, width = yxhw.T
+    x2, y2 = x1 + width, y1 + height
+    x1 = np.minimum(np.maximum(0, x1), w) - dx
+    x2 = np.minimum(np.maximum(x1, x2), w) + dx
+    y1 = np.minimum(np.maximum(0, y1), h) - dy
+    y2 = np.minimum(np.maximum(y1, y2), h) + dy
+    return np.stack([x1, y1, x2, y2], axis=1)
+
+
+def clamp(boxes, img_size):
+    """Clip (n, 4) xyxy boxes to an image of img_size (width, height)."""
+    w, h = img_size
+    return np.stack([np.clip(boxes[:, 0], 0, w), np.clip(boxes[:, 1], 0, h),
+                     np.clip(boxes[:, 2], 0, w), np.clip(boxes[:, 3], 0, h)], axis=1)
+
+
+def valid_mask(boxes, img_size=None, min_size=(1, 1)):
+    """
+    Which boxes are at least min_size (width, height) and, given img_size, at least partly on the image.
+    """
+    x1, y1, x2, y2 = boxes.T
+    min_width, min_height = min_size
+    mask = (x2 - x1 >= min_width) & (y2 - y1 >= min_height)
+    if img_size is not None:
+        w, h = img_size
+        mask &= (np.minimum(x2, w) > np.maximum(x1, 0)) & (np.minimum(y2, h) > np.maximum(y1, 0))
+    return mask
+
+
+def centers(boxes):
+    """Integer centers ((x1 + x2) // 2, (y1 + y2) // 2) of xyxy boxes, as the XML drivers compute them."""
+    return (boxes[:, :2] + boxes[:, 2:]) // 2
+
+
+def _center_distances(a, b):
+    diff = centers(a)[:, None, :] - centers(b)[None, :, :]
+    return np.sqrt((diff ** 2).sum(axis=2))
+
+
+def near_mask(boxes, others, min_dist):
+    """Which boxes have their center within min_dist of the center of one of others."""
+    if len(boxes) == 0 or len(others) == 0:
+        return np.zeros(len(boxes), dtype=bool)
+    return (_center_distances(boxes, others) <= min_dist).any(axis=1)
+
+
+def dedup_by_center(boxes, kept=None, min_dist=0):
+    """
+    Keep, in order, every box whose center is farther than min_dist from the centers of the boxes kept
+    before it, starting from the boxes already kept.
+    :return: indices of boxes kept
+    """
+    kept = np.zeros((0, 4), dtype=boxes.dtype) if kept is None else kept.reshape(-1, 4)
+    everything = np.concatenate([kept, boxes])
+    close = _center_distances(everything, everything) <= min_dist
+    keep = np.zeros(len(everything), dtype=bool)
+    keep[:len(kept)] = True
+    for i in range(len(kept), len(everything)):
+        keep[i] = not close[i, keep].any()
+    return np.flatnonzero(keep[len(kept):])
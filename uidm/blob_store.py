@@ -0,0 +1,113 @@
+import hashlib
+import os
+import shutil
+
+from config import load_config
+from uidm import profiling
+
+configs = load_config()
+
+# (device, inode, mtime_ns, size) of a file -> path of the blob holding its content
+_blobs = {}
+
+
+def _stat_key(stat):
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_path(digest, suffix, store_dir=None):
+    """
+    Path of the blob with the given digest: <store_dir>/<first 2 hex chars>/<digest><suffix>
+    """
+    store_dir = store_dir or configs.get("BLOB_STORE_DIR", "")
+    return os.path.join(store_dir, digest[:2], f'{digest}{suffix}')
+
+
+def put(path, store_dir=None):
+    """
+    Store the content of a file in the blob store, unless an identical blob is already there.
+    :return: path of the blob
+    """
+    key = _stat_key(os.stat(path))
+    blob = _blobs.get(key)
+    if blob is not None and os.path.exists(blob):
+        profiling.count("blob_hit")
+        return blob
+    blob = blob_path(file_digest(path), os.path.splitext(path)[1].lower(), store_dir)
+    if os.path.exists(blob):
+        profiling.count("blob_hit")
+    else:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp_path = f'{blob}.{os.getpid()}.tmp'
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, blob)
+        profiling.count("blob_new")
+    _blobs[key] = blob
+    _blobs[_stat_key(os.stat(blob))] = blob
+    return blob
+
+
+def link(blob, dst):
+    """
+    Replace dst with a hardlink to blob, or with a copy of it if the filesystem cannot link
+    (e.g. the store is on another device).
+    """
+    # renaming a link over another link of the same file is a no-op that would leave the temporary link behind
+    if os.path.exists(dst) and os.path.samefile(blob, dst):
+        return
+    tmp_path = f'{dst}.{os.getpid()}.tmp'
+    try:
+        os.link(blob, tmp_path)
+    except OSError:
+        shutil.copyfile(blob, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def copy_file(src, dst):
+    """
+    Drop-in replacement for shutil.copy of screenshots.
+    With BLOB_STORE_DIR set, the content is stored once under its hash and dst becomes a hardlink to the blob,
+    so identical screenshots take the space of one file and copying one only writes a directory entry.
+    Without it, a dst sharing its content with other files (frames linked by share_file) is unlinked first,
+    so the copy never writes through to them.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if not configs.get("BLOB_STORE_DIR", ""):
+        detach(dst)
+        return shutil.copy(src, dst)
+    link(put(src), dst)
+    return dst
+
+
+def share_file(src, dst):
+    """
+    Give dst the content of src without writing it again: a hardlink to the blob with BLOB_STORE_DIR set,
+    otherwise a hardlink to src itself (or a copy if the filesystem cannot link).
+    """
+    if configs.get("BLOB_STORE_DIR", ""):
+        return copy_file(src, dst)
+    if os.path.abspath(src) != os.path.abspath(dst):
+        link(src, dst)
+    return dst
+
+
+def detach(path):
+    """
+    Unlink path before it is rewritten if it shares its content with the blob store or other files,
+    so writing in place never changes the shared blob.
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,170 @@
+import multiprocessing
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Tuple
+
+import numpy as np
+
+from uidm import array_ops, bboxes
+
+_ALIGN = 64
+# bytes of the per-slot reference counts at the start of the segment
+_COUNT_BYTES = 8
+
+
+@dataclass(frozen=True)
+class FrameHandle:
+    """
+    A decoded frame and its element table in a slot of a FramePool. Handles are what pipeline stages
+    pass to each other; the pixels stay in shared memory.
+    """
+    slot: int
+    size: Tuple[int, int]
+    mode: str
+    elements: int
+    dtype: str
+    # image.info of the decoded frame (PNG save reads e.g. icc_profile and transparency from it)
+    info: dict = None
+
+    @property
+    def frame_bytes(self):
+        return self.size[0] * self.size[1] * len(self.mode)
+
+    @property
+    def table_offset(self):
+        return _aligned(self.frame_bytes)
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _attach(name):
+    try:
+        # Python 3.13+: the creating process owns the segment
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # a process that does not share the creator's resource tracker would unlink the segment on exit
+        if multiprocessing.get_start_method(allow_none=True) not in (None, 'fork'):
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class FramePool:
+    """
+    Fixed-size slots of one shared memory segment, each holding a decoded frame (a (height, width, channels)
+    uint8 array) followed by its element boxes (an (n, 4) array).
+    A slot is taken by put() with one reference; retain() adds a reference for every further stage that
+    will hold the handle and release() drops one, the slot being free again at zero. put() blocks while
+    every slot is in use, so the pool also bounds the frames in flight.
+    The pool is created by the parent process and reaches worker processes through its spec (see connect),
+    which carries the lock and semaphore they share and so must be passed as a process initializer argument.
+    """
+
+    def __init__(self, slots, slot_bytes, spec=None):
+        self.slots = slots
+        self.slot_bytes = _aligned(slot_bytes)
+        self.header_bytes = _aligned(slots * _COUNT_BYTES)
+        if spec is None:
+            self.owner = True
+            self.shm = shared_memory.SharedMemory(create=True, size=self.header_bytes + slots * self.slot_bytes)
+            self.lock = multiprocessing.Lock()
+            self.free = multiprocessing.Semaphore(slots)
+        else:
+            self.owner = False
+            self.shm = _attach(spec["name"])
+            self.lock = spec["lock"]
+            self.free = spec["free"]
+        self.counts = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.counts[:] = 0
+
+    @classmethod
+    def connect(cls, spec):
+        return cls(spec["slots"], spec["slot_bytes"], spec)
+
+    def spec(self):
+        return {"name": self.shm.name, "slots": self.slots, "slot_bytes": self.slot_bytes,
+                "lock": self.lock, "free": self.free}
+
+    def _offset(self, slot):
+        return self.header_bytes + slot * self.slot_bytes
+
+    def fits(self, size, mode, elements, dtype=np.float64):
+        return _aligned(size[0] * size[1] * len(mode)) + elements * 4 * np.dtype(dtype).itemsize <= self.slot_bytes
+
+    def put(self, image, ui_positions, timeout=None):
+        """
+        Copy a decoded frame and its element boxes into a free slot.
+        :return: FrameHandle holding one reference, or None if the frame can not be shared
+        (mode other than RGB/RGBA, larger than a slot, or no slot freed within timeout)
+        """
+        # integer boxes (from XML) stay integers, so the records are the same as without the pool
+        table = bboxes.as_boxes(ui_positions)
+        if image.mode not in array_ops.SUPPORTED_MODES or not self.fits(image.size, image.mode, len(table), table.dtype):
+            return None
+        if not self.free.acquire(timeout=timeout):
+            return None
+        with self.lock:
+            slot = int(np.flatnonzero(self.counts == 0)[0])
+            self.counts[slot] = 1
+        handle = FrameHandle(slot, image.size, image.mode, len(table), table.dtype.str, dict(image.info))
+        self.frame(handle)[...] = np.asarray(image)
+        self.positions(handle)[...] = table
+        return handle
+
+    def retain(self, handle):
+        with self.lock:
+            self.counts[handle.slot] += 1
+
+    def release(self, handle):
+        with self.lock:
+            self.counts[handle.slot] -= 1
+            freed = self.counts[handle.slot] == 0
+        if freed:
+            self.free.release()
+
+    def frame(self, handle):
+        """The frame of a slot as a (height, width, channels) array, sharing the slot's memory."""
+        width, height = handle.size
+        return np.ndarray((height, width, len(handle.mode)), dtype=np.uint8, buffer=self.shm.buf,
+                          offset=self._offset(handle.slot))
+
+    def positions(self, handle):
+        """The element boxes of a slot as an (n, 4) array, sharing the slot's memory."""
+        return np.ndarray((handle.elements, 4), dtype=np.dtype(handle.dtype), buffer=self.shm.buf,
+                          offset=self._offset(handle.slot) + handle.table_offset)
+
+    def image(self, handle):
+        """A PIL Image copy of the frame of a slot, which stays valid after the slot is released."""
+        image = array_ops.array_to_image(self.frame(handle), handle.mode).copy()
+        image.info = dict(handle.info or {})
+        return image
+
+    def close(self):
+        self.counts = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+# the pool of this worker process, see connect
+_pool = None
+
+
+def connect(spec):
+    """Process pool initializer: attach the worker to the frame pool of the parent."""
+    global _pool
+    _pool = FramePool.connect(spec)
+
+
+def worker_pool():
+    return _pool
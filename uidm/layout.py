@@ -0,0 +1,140 @@
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from uidm import bboxes
+
+# kinds of alignment groups, in the order of identify_aligned_groups
+GROUP_KINDS = ("horizontal", "vertical", "center_aligned")
+# axis along which the elements of a group follow each other: a horizontal group is a row (same top),
+# vertical and center-aligned groups are columns
+_GROUP_AXIS = {"horizontal": 0, "vertical": 1, "center_aligned": 1}
+
+
+@dataclass
+class LayoutAnalysis:
+    """
+    Rows and columns of a screen and their statistics, computed once from its alignment groups.
+    Group g holds the element indices members[offsets[g]:offsets[g + 1]] and is of kind
+    GROUP_KINDS[kinds[g]]; the per-group arrays are indexed by g. The gaps between consecutive elements of
+    group g along its axis are gaps[gap_offsets[g]:gap_offsets[g + 1]] (negative where elements overlap).
+    The analysis describes the screen as extracted, not the boxes strategies have moved since.
+    """
+    boxes: np.ndarray
+    kinds: np.ndarray
+    members: np.ndarray
+    offsets: np.ndarray
+    sizes: np.ndarray
+    max_heights: np.ndarray
+    mean_areas: np.ndarray
+    extents: np.ndarray
+    gaps: np.ndarray
+    gap_offsets: np.ndarray
+    gap_means: np.ndarray
+    gap_stds: np.ndarray
+    longest: int
+    tallest: dict
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def group(self, g):
+        return self.members[self.offsets[g]:self.offsets[g + 1]].tolist()
+
+    def groups(self, kind):
+        return [self.group(g) for g in np.flatnonzero(self.kinds == GROUP_KINDS.index(kind))]
+
+    def extent(self, g):
+        """Bounding box (x1, y1, x2, y2) of the elements of group g."""
+        return tuple(self.extents[g].tolist())
+
+    def max_height(self, g):
+        return self.max_heights[g].item()
+
+    def group_gaps(self, g):
+        return self.gaps[self.gap_offsets[g]:self.gap_offsets[g + 1]]
+
+    def longest_group(self):
+        """
+        The group with the most elements, the largest average area breaking ties.
+        :return: (kind, element indices), or None if the screen has no group
+        """
+        if self.longest < 0:
+            return None
+        return GROUP_KINDS[self.kinds[self.longest]], self.group(self.longest)
+
+    def tallest_group(self, kind):
+        """
+        The group of a kind holding the tallest element.
+        :return: group index, or None if the screen has no group of that kind
+        """
+        return self.tallest.get(kind)
+
+
+def _first_max(keys, candidates):
+    """Index among candidates maximizing the keys (compared in order), the first one on ties."""
+    for key in keys:
+        values = key[candidates]
+        candidates = candidates[values == values.max()]
+    return int(candidates[0])
+
+
+def analyze_layout(ui_positions, alignment_el) -> LayoutAnalysis:
+    """
+    Build the layout analysis of a screen.
+    :param ui_positions: element boxes (x1, y1, x2, y2)
+    :param alignment_el: alignment groups of the elements, see identify_aligned_groups
+    """
+    # integer boxes (from XML) stay integers, so boxes derived from the analysis are the same as from the positions
+    boxes = bboxes.as_boxes(ui_positions)
+    groups: List[List[int]] = []
+    kinds = []
+    for k, kind in enumerate(GROUP_KINDS):
+        for group in (alignment_el or {}).get(kind, []):
+            groups.append(group)
+            kinds.append(k)
+    kinds = np.asarray(kinds, dtype=np.int64)
+    sizes = np.asarray([len(group) for group in groups], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    members = np.asarray([idx for group in groups for idx in group], dtype=np.int64)
+    group_of = np.repeat(np.arange(len(groups)), sizes)
+    member_boxes = boxes[members]
+    x1, y1, x2, y2 = member_boxes.T
+    nonempty = sizes > 0
+    starts = offsets[:-1][nonempty]
+    max_heights = np.zeros(len(groups), dtype=boxes.dtype)
+    mean_areas = np.zeros(len(groups))
+    extents = np.zeros((len(groups), 4), dtype=boxes.dtype)
+    if len(members):
+        max_heights[nonempty] = np.maximum.reduceat(y2 - y1, starts)
+        mean_areas[nonempty] = np.add.reduceat((x2 - x1) * (y2 - y1), starts) / sizes[nonempty]
+        extents[nonempty] = np.stack([np.minimum.reduceat(x1, starts), np.minimum.reduceat(y1, starts),
+                                      np.maximum.reduceat(x2, starts), np.maximum.reduceat(y2, starts)], axis=1)
+
+    # order the members of every group along its axis, then take the gap between each consecutive pair
+    axis = np.asarray([_GROUP_AXIS[GROUP_KINDS[k]] for k in kinds], dtype=np.int64)[group_of]
+    lead = np.where(axis == 0, x1, y1)
+    trail = np.where(axis == 0, x2, y2)
+    order = np.lexsort((lead, group_of))
+    same_group = group_of[order][1:] == group_of[order][:-1]
+    gaps = (lead[order][1:] - trail[order][:-1])[same_group]
+    gap_counts = np.maximum(sizes - 1, 0)
+    gap_offsets = np.concatenate(([0], np.cumsum(gap_counts))).astype(np.int64)
+    gap_means = np.full(len(groups), np.nan)
+    gap_stds = np.full(len(groups), np.nan)
+    has_gaps = gap_counts > 0
+    if has_gaps.any():
+        gap_starts = gap_offsets[:-1][has_gaps]
+        gap_means[has_gaps] = np.add.reduceat(gaps, gap_starts) / gap_counts[has_gaps]
+        deviations = gaps - np.repeat(gap_means[has_gaps], gap_counts[has_gaps])
+        gap_stds[has_gaps] = np.sqrt(np.add.reduceat(deviations ** 2, gap_starts) / gap_counts[has_gaps])
+
+    all_groups = np.arange(len(groups))
+    longest = _first_max((sizes, mean_areas), all_groups) if len(groups) else -1
+    tallest = {kind: _first_max((max_heights,), np.flatnonzero(kinds == k))
+               for k, kind in enumerate(GROUP_KINDS) if (kinds == k).any()}
+    return LayoutAnalysis(boxes=boxes, kinds=kinds, members=members, offsets=offsets, sizes=sizes,
+                          max_heights=max_heights, mean_areas=mean_areas, extents=extents, gaps=gaps,
+                          gap_offsets=gap_offsets, gap_means=gap_means, gap_stds=gap_stds, longest=longest,
+                          tallest=tallest)
@@ -0,0 +1,216 @@
+import functools
+import gc
+import json
+import os
+import resource
+import tracemalloc
+from collections import defaultdict
+from multiprocessing import util
+
+from PIL import Image
+
+from config import load_config
+
+configs = load_config()
+
+# allocations of the profiler itself and of imports are not of interest
+_IGNORED = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"), tracemalloc.Filter(False, __file__))
+
+
+def open_fds():
+    """Number of open file descriptors of this process, or None where /proc is not available."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def live_images():
+    """Number of PIL images alive in this process (after a collection, so garbage is not counted)."""
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, Image.Image))
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StrategyMemory:
+    """Peak and retained traced memory (bytes) and leaked file descriptors of the items of one strategy."""
+
+    def __init__(self):
+        self.count = 0
+        self.peak_total = 0
+        self.peak_max = 0
+        self.retained = 0
+        self.leaked_fds = 0
+
+    def add(self, peak, retained, fds):
+        self.count += 1
+        self.peak_total += peak
+        self.peak_max = max(self.peak_max, peak)
+        self.retained += retained
+        self.leaked_fds += max(fds or 0, 0)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_peak_kb": self.peak_total / self.count / 1024 if self.count else 0,
+            "max_peak_kb": self.peak_max / 1024,
+            "retained_kb": self.retained / 1024,
+            "leaked_fds": self.leaked_fds,
+        }
+
+
+def _top_sites(statistics, top):
+    return [{"site": str(stat.traceback), "size_kb": stat.size / 1024, "count": stat.count,
+             **({"size_diff_kb": stat.size_diff / 1024} if hasattr(stat, "size_diff") else {})}
+            for stat in statistics[:top]]
+
+
+class MemoryProfiler:
+    """
+    Memory use of the items of a run (MEMORY_PROFILING), measured with tracemalloc.
+    Each item tracked by ``track`` records the peak traced memory above what was traced when it started,
+    the memory it left traced (retained) and the file descriptors it left open, per (strategy, difficulty).
+    Every snapshot_interval items a snapshot is taken and compared with the previous one, with the number of
+    live PIL images. The report lists the top allocation sites at run end and the sites that grew most since
+    the first snapshot.
+    Worker processes profile their own items and write their report when they exit.
+    """
+
+    def __init__(self, enabled=False, report_path="", snapshot_interval=0, top=10, trace_frames=1,
+                 max_items=100000):
+        self.enabled = enabled
+        self.report_path = report_path
+        self.snapshot_interval = snapshot_interval
+        self.top = top
+        self.trace_frames = trace_frames
+        self.max_items = max_items
+        self.pid = None
+
+    def _start(self):
+        """Start (or, in a forked worker, restart) tracing for this process."""
+        if os.getpid() != _main_pid:
+            # worker processes exit through multiprocessing, which runs its finalizers but not atexit
+            util.Finalize(self, self.report, exitpriority=10)
+        self.pid = os.getpid()
+        self.strategies = defaultdict(StrategyMemory)
+        self.items = []
+        self.snapshots = []
+        self.item_count = 0
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        tracemalloc.start(self.trace_frames)
+        self.first_snapshot = self.last_snapshot = self._snapshot()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(_IGNORED)
+
+    def track(self, func):
+        """
+        Decorator of the function injecting one item: its first argument is the screenshot path and it
+        returns the UIDefectInjection, which gives the strategy and difficulty.
+        """
+        if not self.enabled:
+            return func
+
+        @functools.wraps(func)
+        def tracked(screenshot_path, *args, **kwargs):
+            if self.pid != os.getpid():
+                self._start()
+            fds = open_fds()
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            uidi = None
+            try:
+                uidi = func(screenshot_path, *args, **kwargs)
+                return uidi
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                self.add_item(screenshot_path, uidi, peak - start, current - start,
+                              None if fds is None else open_fds() - fds)
+
+        return tracked
+
+    def add_item(self, screenshot_path, uidi, peak, retained, fds):
+        if uidi is None:
+            strategy, difficulty = "error", ""
+        else:
+            strategy = (uidi.injected_defect or {}).get("strategy") or "none"
+            difficulty = uidi.difficulty
+        self.strategies[(strategy, difficulty)].add(peak, retained, fds)
+        if len(self.items) < self.max_items:
+            self.items.append({"item": str(screenshot_path), "strategy": strategy, "difficulty": difficulty,
+                               "peak_kb": peak / 1024, "retained_kb": retained / 1024, "fds": fds})
+        self.item_count += 1
+        if self.snapshot_interval and self.item_count % self.snapshot_interval == 0:
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        """Compare a new snapshot with the previous one and record the sites that grew most."""
+        snapshot = self._snapshot()
+        self.snapshots.append({
+            "items": self.item_count,
+            "traced_kb": tracemalloc.get_traced_memory()[0] / 1024,
+            "max_rss_kb": max_rss_kb(),
+            "live_images": live_images(),
+            "open_fds": open_fds(),
+            "growth": _top_sites(snapshot.compare_to(self.last_snapshot, "lineno"), self.top),
+        })
+        self.last_snapshot = snapshot
+
+    def summary(self):
+        lines = [f"{'strategy':<24}{'difficulty':<12}{'count':>8}{'mean peak(KB)':>16}{'max peak(KB)':>16}"
+                 f"{'retained(KB)':>16}{'leaked fds':>12}"]
+        for (strategy, difficulty), stats in sorted(self.strategies.items(), key=lambda x: -x[1].peak_max):
+            d = stats.to_dict()
+            lines.append(f"{strategy:<24}{difficulty:<12}{d['count']:>8}{d['mean_peak_kb']:>16.1f}"
+                         f"{d['max_peak_kb']:>16.1f}{d['retained_kb']:>16.1f}{d['leaked_fds']:>12}")
+        lines.append(f"pid {self.pid}: {self.item_count} items, max RSS {max_rss_kb() / 1024:.1f} MB, "
+                     f"{live_images()} live images, {open_fds()} open fds")
+        return "\n".join(lines)
+
+    def report(self):
+        """Print the per-strategy summary and the top allocation sites, and write the report file."""
+        if not self.enabled or self.pid != os.getpid():
+            return
+        snapshot = self._snapshot()
+        top_sites = _top_sites(snapshot.statistics("lineno"), self.top)
+        growth = _top_sites(snapshot.compare_to(self.first_snapshot, "lineno"), self.top)
+        print(self.summary())
+        print("Top allocation sites:")
+        for site in top_sites:
+            print(f"  {site['size_kb']:>10.1f} KB {site['count']:>8} blocks  {site['site']}")
+        if not self.report_path:
+            return
+        path = self.report_path
+        if os.getpid() != _main_pid:
+            root, ext = os.path.splitext(path)
+            path = f'{root}.{os.getpid()}{ext}'
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "pid": self.pid,
+                "max_rss_kb": max_rss_kb(),
+                "strategies": [{"strategy": strategy, "difficulty": difficulty, **stats.to_dict()}
+                               for (strategy, difficulty), stats in self.strategies.items()],
+                "items": self.items,
+                "snapshots": self.snapshots,
+                "top_sites": top_sites,
+                "growth": growth,
+            }, f, indent=2)
+        print(f"Memory profile written to {path}")
+
+
+_main_pid = os.getpid()
+memory_profiler = MemoryProfiler(
+    enabled=configs.get("MEMORY_PROFILING", False),
+    report_path=configs.get("MEMORY_PROFILE_PATH", "./memory_profile.json"),
+    snapshot_interval=configs.get("MEMORY_SNAPSHOT_INTERVAL", 0),
+    top=configs.get("MEMORY_TOP_SITES", 10),
+    trace_frames=configs.get("MEMORY_TRACE_FRAMES", 1),
+    max_items=configs.get("PROFILE_MAX_EVENTS", 100000),
+)
+track = memory_profiler.track
+report = memory_profiler.report
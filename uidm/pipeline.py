@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+
+from uidm.utils import iter_json_array
+
+_DONE = object()
+
+
+class JsonArrayWriter:
+    """
+    Write items to a JSON array file one by one, in the same layout as ``json.dump(data, f, indent=4)``.
+    With append, items already in the file are kept (streamed, not loaded) and new items follow them.
+    The file is written to a temporary path and moved into place on close, so the old file can be
+    read while its replacement is being written.
+    """
+
+    def __init__(self, path, indent=4, ensure_ascii=True, append=True):
+        self.path = path
+        self.indent = indent
+        self.ensure_ascii = ensure_ascii
+        self.count = 0
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.f = open(self.tmp_path, 'w', encoding='utf-8')
+        self.f.write('[')
+        if append and os.path.exists(path):
+            try:
+                for item in iter_json_array(path):
+                    self.write(item)
+            except ValueError:
+                pass
+
+    def write(self, item):
+        text = json.dumps(item, indent=self.indent, ensure_ascii=self.ensure_ascii)
+        pad = ' ' * self.indent
+        self.f.write(',\n' if self.count else '\n')
+        self.f.write('\n'.join(pad + line for line in text.split('\n')))
+        self.count += 1
+
+    def close(self):
+        self.f.write('\n]' if self.count else ']')
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Discard everything written so far and leave the original file untouched."""
+        self.f.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def rewrite_json_array(path, transform, indent=4, ensure_ascii=True):
+    """
+    Stream the items of a JSON array file through transform and write the results back in place.
+    Items for which transform returns None are dropped.
+    :return: number of items written
+    """
+    with JsonArrayWriter(path, indent=indent, ensure_ascii=ensure_ascii, append=False) as writer:
+        for item in iter_json_array(path):
+            item = transform(item)
+            if item is not None:
+                writer.write(item)
+    return writer.count
+
+
+async def run_pipeline(items, prefetch, process, sink=None, concurrency=8, executor=None):
+    """
+    Run items through prefetch -> process -> sink with bounded concurrency.
+    - prefetch(item): blocking I/O (copy, XML parse, reads), run in the default thread pool.
+    - process(prefetched): CPU-bound work, run in ``executor`` (None: default thread pool).
+    - sink(result): blocking write, run by a single writer task in completion order. None results
+      (items that produced nothing) are not passed to it.
+    At most ``concurrency`` items are in flight; a slow sink applies backpressure to the input walk.
+    If the sink or an item raises, the items in flight are cancelled and the (first) error is raised.
+    :param items: iterable of work items, consumed lazily off the event loop
+    :return: number of processed items
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue(maxsize=concurrency)
+    processed = 0
+
+    async def drain():
+        while True:
+            result = await results.get()
+            if result is _DONE:
+                return
+            if sink is not None and result is not None:
+                await asyncio.to_thread(sink, result)
+
+    async def handle(item):
+        nonlocal processed
+        try:
+            prefetched = await asyncio.to_thread(prefetch, item)
+            result = await loop.run_in_executor(executor, process, prefetched)
+            await results.put(result)
+            processed += 1
+        finally:
+            slots.release()
+
+    async def watched(awaitable):
+        """Await awaitable, unless the writer dies first: then raise its error (handlers would block on a full queue)."""
+        task = asyncio.ensure_future(awaitable)
+        await asyncio.wait({task, writer}, return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+            writer.result()
+            raise RuntimeError("pipeline writer stopped before the end of the input")
+        return task.result()
+
+    def finished(task):
+        tasks.discard(task)
+        # a finished handler leaves the set, so its error is kept to be raised by the admission loop
+        if not task.cancelled() and task.exception() is not None:
+            failures.append(task.exception())
+
+    writer = asyncio.create_task(drain())
+    tasks = set()
+    failures = []
+    try:
+        iterator = iter(items)
+        while True:
+            await watched(slots.acquire())
+            if failures:
+                raise failures[0]
+            item = await asyncio.to_thread(next, iterator, _DONE)
+            if item is _DONE:
+                slots.release()
+                break
+            task = asyncio.create_task(handle(item))
+            tasks.add(task)
+            task.add_done_callback(finished)
+        await watched(asyncio.gather(*tasks))
+        if failures:
+            raise failures[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+        if not writer.done():
+            await results.put(_DONE)
+        await writer
+    return processed
@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+from config import load_config
+
+configs = load_config()
+
+
+class StageStats:
+    """Count, total/min/max duration and a log2 histogram (in microseconds) of one stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.buckets = defaultdict(int)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        # bucket i holds durations in [2^(i-1), 2^i) microseconds
+        self.buckets[int(duration * 1e6).bit_length()] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for bucket, n in other.buckets.items():
+            self.buckets[bucket] += n
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_ms": self.total / self.count * 1e3 if self.count else 0,
+            "min_ms": self.min * 1e3 if self.count else 0,
+            "max_ms": self.max * 1e3,
+            "histogram_us": {f"<{2 ** b}": n for b, n in sorted(self.buckets.items())},
+        }
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "tags", "start")
+
+    def __init__(self, profiler, name, tags):
+        self.profiler = profiler
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.tags)
+        return False
+
+
+class _Tagged:
+    __slots__ = ("profiler", "tags", "previous")
+
+    def __init__(self, profiler, tags):
+        self.profiler = profiler
+        self.tags = tags
+
+    def __enter__(self):
+        self.previous = self.profiler.current_tags()
+        self.profiler._local.tags = {**self.previous, **self.tags}
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler._local.tags = self.previous
+        return False
+
+
+class Profiler:
+    """
+    Per-stage timing of a run.
+    Stages are recorded per (stage, strategy, difficulty), where strategy/difficulty come from the
+    enclosing ``tagged`` block. When disabled every hook is a shared no-op context manager.
+    Worker processes record into their own profiler: ``take`` hands over what they recorded so the
+    main process can ``merge`` it before reporting.
+    """
+
+    def __init__(self, enabled=False, trace_path="", max_events=100000):
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.max_events = max_events
+        self.stats = defaultdict(StageStats)
+        self.counters = defaultdict(int)
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def _reset(self):
+        self.stats = defaultdict(StageStats)
+        self.counters = defaultdict(int)
+        self.events = []
+
+    def _check_pid(self):
+        # a forked worker starts with a copy of what the main process had recorded: drop it, the main
+        # process reports that itself
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+
+    def current_tags(self):
+        return getattr(self._local, "tags", {})
+
+    def tagged(self, **tags):
+        if not self.enabled:
+            return nullcontext()
+        return _Tagged(self, tags)
+
+    def stage(self, name, **tags):
+        if not self.enabled:
+            return nullcontext()
+        return _Stage(self, name, {**self.current_tags(), **tags})
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        tags = self.current_tags()
+        with self._lock:
+            self._check_pid()
+            self.counters[(name, tags.get("strategy", ""), tags.get("difficulty", ""))] += n
+
+    def record(self, name, start, duration, tags):
+        key = (name, tags.get("strategy", ""), tags.get("difficulty", ""))
+        with self._lock:
+            self._check_pid()
+            self.stats[key].add(duration)
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self._origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": tags,
+                })
+
+    def take(self):
+        """
+        Hand over and clear what this process recorded since the last take, to be merged by the main process.
+        :return: picklable (stats, counters, events), or None when disabled
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._check_pid()
+            taken = (dict(self.stats), dict(self.counters), self.events)
+            self._reset()
+        return taken
+
+    def merge(self, taken):
+        """Add what a worker process recorded (see take) to this profiler."""
+        if taken is None:
+            return
+        stats, counters, events = taken
+        with self._lock:
+            for key, other in stats.items():
+                self.stats[key].merge(other)
+            for key, n in counters.items():
+                self.counters[key] += n
+            self.events.extend(events[:max(self.max_events - len(self.events), 0)])
+
+    def summary(self):
+        lines = [f"{'stage':<16}{'strategy':<24}{'difficulty':<12}{'count':>8}{'total(s)':>12}{'mean(ms)':>12}"
+                 f"{'max(ms)':>12}"]
+        for (name, strategy, difficulty), stats in sorted(self.stats.items(), key=lambda x: -x[1].total):
+            lines.append(f"{name:<16}{strategy:<24}{difficulty:<12}{stats.count:>8}{stats.total:>12.3f}"
+                         f"{stats.total / stats.count * 1e3:>12.2f}{stats.max * 1e3:>12.2f}")
+        for (name, strategy, difficulty), n in sorted(self.counters.items()):
+            lines.append(f"{name:<16}{strategy:<24}{difficulty:<12}{n:>8}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """
+        Write the recorded stages as a Chrome trace (chrome://tracing, Perfetto), with the
+        aggregated stats and counters stored alongside the trace events.
+        """
+        with self._lock:
+            data = {
+                "traceEvents": list(self.events),
+                "displayTimeUnit": "ms",
+                "stats": [{"stage": name, "strategy": strategy, "difficulty": difficulty, **stats.to_dict()}
+                          for (name, strategy, difficulty), stats in self.stats.items()],
+                "counters": [{"name": name, "strategy": strategy, "difficulty": difficulty, "count": n}
+                             for (name, strategy, difficulty), n in self.counters.items()],
+            }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+    def report(self):
+        """Print the run summary and write the trace file, if profiling is enabled."""
+        if not self.enabled:
+            return
+        print(self.summary())
+        if self.trace_path:
+            self.dump(self.trace_path)
+            print(f"Profile trace written to {self.trace_path}")
+
+
+profiler = Profiler(
+    enabled=configs.get("PROFILING", False),
+    trace_path=configs.get("PROFILE_TRACE_PATH", "./profile_trace.json"),
+    max_events=configs.get("PROFILE_MAX_EVENTS", 100000),
+)
+stage = profiler.stage
+tagged = profiler.tagged
+count = profiler.count
+take = profiler.take
+merge = profiler.merge
+report = profiler.report
@@ -0,0 +1,212 @@
+import ast
+import json
+import os
+import shutil
+
+from uidm.utils import is_json_array, iter_json_array
+
+FORMAT = "uidm-records"
+VERSION = 1
+RECORDS_SUFFIX = ".records.jsonl"
+# item fields holding a screenshot path or a list of them
+PATH_FIELDS = ("image_path", "imgs_path", "labeled_path")
+# item fields holding a stringified list, or a list of them (one per screenshot of a crawler test case)
+LIST_FIELDS = ("ui_positions", "ui_text", "ui_type")
+
+
+def records_path(json_path):
+    """Path of the records file converted from a JSON array file: <name>.records.jsonl next to it."""
+    return f'{os.path.splitext(json_path)[0]}{RECORDS_SUFFIX}'
+
+
+def parse_list(value, positions=False):
+    """
+    Parse a stringified list as the drivers store them: JSON, or a Python literal (e.g. a list of tuples).
+    Values that are not strings are returned as they are, and so are strings that are not a list.
+    :param positions: the list holds boxes, whose tuples can be read as JSON arrays
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value.replace('(', '[').replace(')', ']') if positions else value)
+    except ValueError:
+        pass
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return value
+    return parsed if isinstance(parsed, (list, tuple)) else value
+
+
+def split_path(path):
+    """Split a path after its last '/': ('dir/sub/', 'name.png'), ('', 'name.png') for a bare name."""
+    cut = path.rfind('/') + 1
+    return path[:cut], path[cut:]
+
+
+def to_record(item, prefixes):
+    """
+    Convert one item of a JSON array file to a record: paths become [prefix id, name] (prefixes maps each
+    prefix to its id and is extended as new prefixes appear) and stringified lists become nested lists.
+    """
+    record = dict(item)
+    for key in PATH_FIELDS:
+        value = record.get(key)
+        if isinstance(value, str) and value:
+            record[key] = _encode_path(value, prefixes)
+        elif isinstance(value, list):
+            record[key] = [_encode_path(path, prefixes) if isinstance(path, str) and path else path
+                           for path in value]
+    for key in LIST_FIELDS:
+        value = record.get(key)
+        if isinstance(value, str):
+            record[key] = parse_list(value, key == "ui_positions")
+        elif isinstance(value, list) and any(isinstance(v, str) for v in value):
+            record[key] = [parse_list(v, key == "ui_positions") for v in value]
+    return record
+
+
+def _encode_path(path, prefixes):
+    prefix, name = split_path(path)
+    if prefix not in prefixes:
+        prefixes[prefix] = len(prefixes)
+    return [prefixes[prefix], name]
+
+
+def _decode_path(value, prefixes):
+    if isinstance(value, list) and len(value) == 2 and isinstance(value[0], int):
+        return prefixes[value[0]] + value[1]
+    return value
+
+
+def from_record(record, prefixes):
+    """
+    Item of a record with its paths joined; lists stay native.
+    :param prefixes: prefix table of the records file
+    """
+    for key in PATH_FIELDS:
+        value = record.get(key)
+        if not isinstance(value, list) or not value:
+            continue
+        if isinstance(value[0], list):
+            record[key] = [_decode_path(path, prefixes) for path in value]
+        else:
+            record[key] = _decode_path(value, prefixes)
+    return record
+
+
+def _write_header(f, prefixes, rewrites=()):
+    header = {"format": FORMAT, "version": VERSION, "prefixes": prefixes}
+    if rewrites:
+        header["rewrites"] = list(rewrites)
+    f.write(json.dumps(header, ensure_ascii=False))
+    f.write('\n')
+
+
+def write_records(path, items):
+    """
+    Write items as a records file. The record lines are written first to a temporary file, since the
+    header holding the prefix table comes first and is only complete after the last item.
+    :return: number of records written
+    """
+    prefixes = {}
+    count = 0
+    body_path = f'{path}.{os.getpid()}.body'
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(body_path, 'w', encoding='utf-8') as body:
+            for item in items:
+                body.write(json.dumps(to_record(item, prefixes), ensure_ascii=False))
+                body.write('\n')
+                count += 1
+        with open(tmp_path, 'w', encoding='utf-8') as f, open(body_path, 'r', encoding='utf-8') as body:
+            _write_header(f, list(prefixes))
+            shutil.copyfileobj(body, f)
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (body_path, tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return count
+
+
+def convert_json(json_path, path=None):
+    """
+    Convert a JSON array file of items (crawler test cases, AitW steps, records of uidm_main) to a records file.
+    :return: path of the records file
+    """
+    path = path or records_path(json_path)
+    write_records(path, iter_json_array(json_path))
+    return path
+
+
+def ensure_records(json_path):
+    """Convert a JSON array file unless its records file is already newer than it."""
+    path = records_path(json_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(json_path):
+        convert_json(json_path, path)
+    return path
+
+
+def convert_tree(root_dir):
+    """
+    Convert every JSON array file under root_dir that has no up-to-date records file.
+    :return: paths of the records files
+    """
+    converted = []
+    for subdir, _, files in os.walk(root_dir):
+        for file in files:
+            json_path = os.path.join(subdir, file)
+            if file.endswith('.json') and is_json_array(json_path):
+                converted.append(ensure_records(json_path))
+    return converted
+
+
+def read_header(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+    if header.get("format") != FORMAT:
+        raise ValueError(f"{path} is not a {FORMAT} file")
+    return header
+
+
+def iter_records(path):
+    """
+    Yield the items of a records file with their paths joined; boxes, texts and types are nested lists.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT:
+            raise ValueError(f"{path} is not a {FORMAT} file")
+        prefixes = header["prefixes"]
+        for line in f:
+            if line.strip():
+                yield from_record(json.loads(line), prefixes)
+
+
+def rewrite_prefixes(path, rewrite, name=None):
+    """
+    Rewrite every path of a records file by rewriting the prefix table only; record lines are copied
+    without being parsed.
+    :param rewrite: function of a prefix (the part of a path up to and including its last '/') to its new value
+    :param name: name of the rewrite, recorded in the header ("rewrites"): a named rewrite the file already
+    went through is skipped, so it is applied once however many times the caller runs
+    :return: whether the file was rewritten
+    """
+    header = read_header(path)
+    rewrites = header.get("rewrites", [])
+    if name is not None:
+        if name in rewrites:
+            return False
+        rewrites = rewrites + [name]
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(path, 'r', encoding='utf-8') as f, open(tmp_path, 'w', encoding='utf-8') as out:
+            f.readline()
+            _write_header(out, [rewrite(prefix) for prefix in header["prefixes"]], rewrites)
+            shutil.copyfileobj(f, out)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
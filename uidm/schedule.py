@@ -0,0 +1,92 @@
+import random
+from collections import Counter
+
+from config import load_config
+from uidm.pipeline import JsonArrayWriter
+from uidm.ui_defects import LAYOUT_STRATEGIES, eligible_elements, identify_aligned_groups
+from uidm.utils import iter_json_array
+
+configs = load_config()
+
+
+def strategy_weights(strategies):
+    """
+    Relative target share of each strategy from STRATEGY_QUOTAS; strategies without a quota weigh 1.
+    """
+    quotas = configs.get("STRATEGY_QUOTAS") or {}
+    return [float(quotas.get(strategy, 1)) for strategy in strategies]
+
+
+def choose_strategy(strategies):
+    """Draw one strategy according to STRATEGY_QUOTAS (a plain random.choice when there are no quotas)."""
+    weights = strategy_weights(strategies)
+    if len(set(weights)) <= 1:
+        return random.choice(strategies)
+    return random.choices(strategies, weights)[0]
+
+
+def eligible_strategies(ui_positions, ui_texts, frame_size, strategies=None, alignment_el=None):
+    """
+    Strategies that have at least one eligible element on a screenshot.
+    :param alignment_el: alignment groups of the elements, see eligible_elements; computed once here for
+    the layout strategies if not given
+    """
+    strategies = strategies or configs["STRATEGY"]
+    if alignment_el is None and any(strategy in LAYOUT_STRATEGIES for strategy in strategies):
+        alignment_el = identify_aligned_groups(ui_positions)
+    return [strategy for strategy in strategies
+            if eligible_elements(ui_positions, ui_texts, strategy, frame_size, alignment_el).any()]
+
+
+def quota_targets(total, strategies):
+    """
+    Split total injections between strategies in proportion to their weights (largest remainder).
+    """
+    weights = strategy_weights(strategies)
+    weight_sum = sum(weights) or 1
+    shares = [total * weight / weight_sum for weight in weights]
+    targets = [int(share) for share in shares]
+    by_remainder = sorted(range(len(strategies)), key=lambda i: shares[i] - targets[i], reverse=True)
+    for i in by_remainder[:total - sum(targets)]:
+        targets[i] += 1
+    return dict(zip(strategies, targets))
+
+
+def plan_schedule(eligibility, strategies=None):
+    """
+    Assign one strategy to every screenshot so the corpus matches the quota targets.
+    Screenshots with the fewest eligible strategies are assigned first, each to the eligible strategy
+    furthest below its target relative to the target, so a strategy that can not reach its target leaves
+    the others in proportion; ties are broken at random.
+    :param eligibility: dict of screenshot -> list of eligible strategies
+    :return: dict of screenshot -> strategy (screenshots with no eligible strategy with a quota are left out)
+    """
+    strategies = strategies or configs["STRATEGY"]
+    keys = [key for key, eligible in eligibility.items() if eligible]
+    targets = quota_targets(len(keys), strategies)
+    assigned = Counter()
+    schedule = {}
+    random.shuffle(keys)
+    for key in sorted(keys, key=lambda k: len(eligibility[k])):
+        candidates = [strategy for strategy in eligibility[key] if targets.get(strategy)]
+        if not candidates:
+            continue
+        deficits = {strategy: (targets[strategy] - assigned[strategy]) / targets[strategy] for strategy in candidates}
+        deficit = max(deficits.values())
+        strategy = random.choice([strategy for strategy in candidates if deficits[strategy] == deficit])
+        schedule[key] = strategy
+        assigned[strategy] += 1
+    return schedule
+
+
+def write_schedule(schedule, path):
+    with JsonArrayWriter(path, indent=2, append=False) as writer:
+        for screenshot, strategy in schedule.items():
+            writer.write({"screenshot": screenshot, "strategy": strategy})
+
+
+def load_schedule(path):
+    """
+    :return: dict of screenshot -> strategy
+    """
+    return {item["screenshot"]: item["strategy"] for item in iter_json_array(path)}
@@ -0,0 +1,279 @@
+import os
+import struct
+import zlib
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from config import load_config
+
+configs = load_config()
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color type -> (channels, PIL mode) for 8-bit images
+_COLOR_TYPES = {0: (1, 'L'), 2: (3, 'RGB'), 3: (1, 'P'), 4: (2, 'LA'), 6: (4, 'RGBA')}
+_WRITE_COLOR_TYPES = {'L': 0, 'RGB': 2, 'LA': 4, 'RGBA': 6}
+_IDAT_SIZE = 1 << 16
+
+
+def _iter_chunks(f):
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        data = f.read(length)
+        f.read(4)
+        yield chunk_type, data
+        if chunk_type == b'IEND':
+            return
+
+
+def _chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+class PngHeader:
+    """IHDR of a PNG plus the chunks needed to decode its pixels (PLTE, tRNS, ...)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.streamable = False
+        with open(path, 'rb') as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return
+            chunks = _iter_chunks(f)
+            chunk_type, ihdr = next(chunks, (None, b''))
+            if chunk_type != b'IHDR':
+                return
+            self.width, self.height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', ihdr)
+            self.ihdr = ihdr
+            self.extra = []
+            for chunk_type, data in chunks:
+                if chunk_type == b'IDAT':
+                    break
+                if chunk_type in (b'PLTE', b'tRNS', b'gAMA', b'sRGB', b'iCCP', b'cHRM'):
+                    self.extra.append(_chunk(chunk_type, data))
+        # strips are decoded by Pillow one band at a time, which needs whole-byte, non-interlaced rows
+        if bit_depth == 8 and interlace == 0 and color_type in _COLOR_TYPES:
+            self.channels, self.mode = _COLOR_TYPES[color_type]
+            self.row_bytes = self.width * self.channels
+            self.streamable = True
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def decode_band(self, prev_row, filtered):
+        """
+        Decode filtered scanlines with Pillow, given the unfiltered scanline above them.
+        The band is wrapped in a small PNG whose first row is prev_row stored unfiltered.
+        """
+        rows = len(filtered) // (self.row_bytes + 1)
+        ihdr = struct.pack('>II', self.width, rows + 1) + self.ihdr[8:]
+        data = zlib.compress(b'\x00' + prev_row + filtered, 0)
+        png = PNG_SIGNATURE + _chunk(b'IHDR', ihdr) + b''.join(self.extra) + _chunk(b'IDAT', data) + \
+            _chunk(b'IEND', b'')
+        band = Image.open(BytesIO(png))
+        band.load()
+        return band.crop((0, 1, self.width, rows + 1))
+
+
+def budget_bytes():
+    return int(configs.get("FRAME_MEMORY_BUDGET_MB", 64) * (1 << 20))
+
+
+def fits_budget(frame_bytes):
+    """Whether a decoded frame fits in FRAME_MEMORY_BUDGET_MB (0 disables the budget)."""
+    return budget_bytes() <= 0 or frame_bytes <= budget_bytes()
+
+
+def over_budget(image_path):
+    """
+    Whether a screenshot should be handled in strips: a streamable PNG whose decoded frame
+    does not fit in the memory budget.
+    """
+    if not image_path.lower().endswith('.png') or budget_bytes() <= 0:
+        return False
+    header = PngHeader(image_path)
+    return header.streamable and not fits_budget(header.row_bytes * header.height)
+
+
+def strip_rows(row_bytes):
+    """Rows per strip: a strip takes at most 1/16 of the memory budget."""
+    return max(16, budget_bytes() // 16 // max(row_bytes, 1))
+
+
+def iter_strips(image_path, stop=None):
+    """
+    Decode a PNG strip by strip; only one strip (and the compressed stream buffer) is in memory at a time.
+    :param stop: stop after the strip containing row stop - 1
+    :return: iterator of (top row, PIL Image strip)
+    """
+    header = PngHeader(image_path)
+    if not header.streamable:
+        raise ValueError(f"{image_path} can not be decoded in strips")
+    stop = header.height if stop is None else min(stop, header.height)
+    line = header.row_bytes + 1
+    rows = strip_rows(header.row_bytes)
+    inflater = zlib.decompressobj()
+    pending = bytearray()
+    data = b''
+    prev_row = bytes(header.row_bytes)
+    top = 0
+    with open(image_path, 'rb') as f:
+        f.read(8)
+        chunks = _iter_chunks(f)
+        while top < stop:
+            need = min(rows, header.height - top) * line
+            while len(pending) < need:
+                if not data:
+                    chunk_type, data = next(chunks, (b'IEND', b''))
+                    if chunk_type == b'IEND':
+                        raise ValueError(f"{image_path}: truncated image data")
+                    if chunk_type != b'IDAT':
+                        data = b''
+                        continue
+                # inflate no more than the strip needs: flat screenshots compress a thousandfold
+                pending += inflater.decompress(data, need - len(pending))
+                data = inflater.unconsumed_tail
+            band = header.decode_band(prev_row, bytes(pending[:need]))
+            del pending[:need]
+            prev_row = band.crop((0, band.height - 1, band.width, band.height)).tobytes()
+            yield top, band
+            top += band.height
+
+
+def _new_like(strip, size):
+    image = Image.new(strip.mode, size)
+    if strip.mode == 'P':
+        image.putpalette(strip.getpalette())
+        image.info = dict(strip.info)
+    return image
+
+
+def read_rows(image_path, top, bottom):
+    """
+    Decode rows [top, bottom) of a PNG without holding the whole frame.
+    """
+    band = None
+    for y, strip in iter_strips(image_path, stop=bottom):
+        if band is None:
+            band = _new_like(strip, (strip.width, bottom - top))
+        if y + strip.height > top:
+            band.paste(strip, (0, y - top))
+    return band
+
+
+def crop_boxes(image_path, boxes):
+    """
+    Crop several element boxes from a PNG in one pass over its strips.
+    Boxes are rounded like Image.crop and clipped to the frame.
+    :return: list of PIL Images, None for boxes with no visible pixels
+    """
+    header = PngHeader(image_path)
+    clipped = []
+    for box in boxes:
+        x1, y1, x2, y2 = map(int, map(round, box))
+        x1, y1, x2, y2 = max(x1, 0), max(y1, 0), min(x2, header.width), min(y2, header.height)
+        clipped.append((x1, y1, x2, y2) if x1 < x2 and y1 < y2 else None)
+    crops = [None] * len(boxes)
+    bottom = max((box[3] for box in clipped if box), default=0)
+    for y, strip in iter_strips(image_path, stop=bottom):
+        for i, box in enumerate(clipped):
+            if box is None or box[3] <= y or box[1] >= y + strip.height:
+                continue
+            x1, y1, x2, y2 = box
+            if crops[i] is None:
+                crops[i] = _new_like(strip, (x2 - x1, y2 - y1))
+            rows = strip.crop((x1, max(y1, y) - y, x2, min(y2, y + strip.height) - y))
+            crops[i].paste(rows, (0, max(y, y1) - y1))
+    return crops
+
+
+class PngStripWriter:
+    """
+    Encode a PNG strip by strip. Each row is filtered with None, Sub or Up (whichever has the smallest
+    sum of absolute differences) and compressed as it arrives; the file is written to a temporary path
+    and moved into place on close.
+    Strips in other modes than L, LA, RGB, RGBA are converted to RGBA.
+    """
+
+    def __init__(self, path, size, mode, compress_level=6):
+        self.path = path
+        self.width, self.height = size
+        self.mode = mode if mode in _WRITE_COLOR_TYPES else 'RGBA'
+        self.channels = len(self.mode)
+        self.rows = 0
+        self.prev_row = np.zeros(self.width * self.channels, dtype=np.uint8)
+        self.compressor = zlib.compressobj(compress_level)
+        self.buffer = bytearray()
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.f = open(self.tmp_path, 'wb')
+        ihdr = struct.pack('>IIBBBBB', self.width, self.height, 8, _WRITE_COLOR_TYPES[self.mode], 0, 0, 0)
+        self.f.write(PNG_SIGNATURE + _chunk(b'IHDR', ihdr))
+
+    def write(self, strip):
+        if strip.mode != self.mode:
+            strip = strip.convert(self.mode)
+        rows = np.asarray(strip, dtype=np.uint8).reshape(strip.height, self.width * self.channels)
+        above = np.vstack([self.prev_row[None], rows[:-1]])
+        left = np.zeros_like(rows)
+        left[:, self.channels:] = rows[:, :-self.channels]
+        candidates = np.stack([rows, rows - left, rows - above])
+        cost = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        filters = cost.argmin(axis=0).astype(np.uint8)
+        lines = np.empty((strip.height, rows.shape[1] + 1), dtype=np.uint8)
+        lines[:, 0] = filters
+        lines[:, 1:] = candidates[filters, np.arange(strip.height)]
+        self.buffer += self.compressor.compress(lines.tobytes())
+        self._flush(_IDAT_SIZE)
+        self.prev_row = rows[-1].copy()
+        self.rows += strip.height
+
+    def _flush(self, min_size=1):
+        while len(self.buffer) >= min_size:
+            data = bytes(self.buffer[:_IDAT_SIZE])
+            del self.buffer[:_IDAT_SIZE]
+            self.f.write(_chunk(b'IDAT', data))
+
+    def close(self):
+        if self.rows != self.height:
+            self.abort()
+            raise ValueError(f"{self.path}: wrote {self.rows} rows, expected {self.height}")
+        self.buffer += self.compressor.flush()
+        self._flush()
+        self.f.write(_chunk(b'IEND', b''))
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Discard the partial output and leave the original file untouched."""
+        self.f.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def splice_rows(image_path, top, band):
+    """
+    Write band over rows [top, top + band.height) of a PNG, streaming every other row through unchanged.
+    """
+    header = PngHeader(image_path)
+    with PngStripWriter(image_path, header.size, band.mode) as writer:
+        for y, strip in iter_strips(image_path):
+            if y < top + band.height and y + strip.height > top:
+                if strip.mode != band.mode:
+                    strip = strip.convert(band.mode)
+                strip.paste(band.crop((0, max(y - top, 0), band.width, min(y + strip.height - top, band.height))),
+                            (0, max(top - y, 0)))
+            writer.write(strip)
@@ -1,19 +1,96 @@
-import glob
 import json
+import math
 import os
 import random
-import shutil
 import uuid
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Tuple, List
 from collections import Counter
 
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 
 import config
+from uidm import array_ops, bboxes, blob_store, layout, profiling, strips
 
 configs = config.load_config()
-Image.MAX_IMAGE_PIXELS = None
+# decompression bomb guard: Pillow warns above MAX_IMAGE_PIXELS and refuses images twice as large
+Image.MAX_IMAGE_PIXELS = configs.get("MAX_IMAGE_PIXELS", 200000000)
+
+
+# the last PNG screenshot decoded or written by this process: (path, file key, image)
+_last_frame = (None, None, None)
+
+
+def _file_key(image_path):
+    stat = os.stat(image_path)
+    # the inode changes when a screenshot is relinked or replaced, even within the mtime resolution
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _keep_frame(screenshot, image_path):
+    global _last_frame
+    frame_bytes = screenshot.width * screenshot.height * len(screenshot.getbands())
+    if image_path.lower().endswith('.png') and strips.fits_budget(frame_bytes):
+        _last_frame = (os.path.abspath(image_path), _file_key(image_path), screenshot)
+
+
+def load_screenshot(image_path):
+    """
+    Open and decode a screenshot.
+    The last PNG decoded or saved is kept in memory: while its file is unchanged, a copy of that frame
+    is returned instead, so planning, chained strategies and labeling decode each screenshot once.
+    :param image_path:
+    :return: decoded PIL Image
+    """
+    frame_path, frame_key, frame = _last_frame
+    if frame_path == os.path.abspath(image_path) and frame_key == _file_key(image_path):
+        return frame.copy()
+    with profiling.stage("decode"):
+        screenshot = Image.open(image_path)
+        screenshot.load()
+    _keep_frame(screenshot, image_path)
+    return screenshot.copy() if _last_frame[2] is screenshot else screenshot
+
+
+def prime_frame(screenshot, image_path):
+    """
+    Hand load_screenshot a frame of image_path decoded elsewhere (e.g. received through a uidm.frames pool),
+    so it is not decoded again. The frame must match the file as it is now.
+    """
+    _keep_frame(screenshot, image_path)
+
+
+def save_screenshot(screenshot, image_path):
+    blob_store.detach(image_path)
+    with profiling.stage("encode"):
+        screenshot.save(image_path)
+    _keep_frame(screenshot, image_path)
+
+
+@lru_cache(maxsize=256)
+def load_font(font_path, size):
+    """Open a TrueType font once per size; faces are shared read-only by all strategies."""
+    return ImageFont.truetype(font_path, size)
+
+
+@lru_cache(maxsize=8)
+def load_broken_images(resource_dir):
+    """
+    The decoded broken-image assets of resource_dir/broken_images, in directory order.
+    :return: list of PIL Images
+    """
+    broken_img_dir = os.path.join(resource_dir, "broken_images")
+    broken_imgs = []
+    for name in os.listdir(broken_img_dir):
+        if name.endswith(('png', 'jpg', 'jpeg')):
+            broken_img = Image.open(os.path.join(broken_img_dir, name))
+            broken_img.load()
+            broken_imgs.append(broken_img)
+    return broken_imgs
+
 
 def identify_el_size(img_size, bbox):
     """
@@ -41,13 +118,14 @@ def get_dominant_color(cropped_img):
     :param cropped_img:
     :return:
     """
-    if cropped_img.mode != 'RGB':
-        cropped_img = cropped_img.convert('RGB')
+    with profiling.stage("dominant_color"):
+        if cropped_img.mode != 'RGB':
+            cropped_img = cropped_img.convert('RGB')
 
-    pixels = list(cropped_img.getdata())
-    color_counts = Counter(pixels)
+        pixels = list(cropped_img.getdata())
+        color_counts = Counter(pixels)
 
-    dominant_color = color_counts.most_common(1)[0][0]
+        dominant_color = color_counts.most_common(1)[0][0]
     return dominant_color
 
 
@@ -119,7 +197,20 @@ class UIDefectInjection:
     difficulty: str = "simple"
 
     def __post_init__(self):
-        self.alignment_el = identify_aligned_groups(self.ui_positions)
+        # fill colors planned for multi-element injections, see plan_fill_colors (not part of the record)
+        self.fill_colors = {}
+        self._layout = None
+        if self.alignment_el is None:
+            with profiling.stage("alignment"):
+                self.alignment_el = identify_aligned_groups(self.ui_positions)
+
+    @property
+    def layout(self) -> layout.LayoutAnalysis:
+        """Layout analysis of the screen, computed on first use (not part of the record)."""
+        if self._layout is None:
+            with profiling.stage("layout"):
+                self._layout = layout.analyze_layout(self.ui_positions, self.alignment_el)
+        return self._layout
 
     def __str__(self):
         return f"UIDefectInjection(image_path={self.image_path}, ui_positions={self.ui_positions}, " \
@@ -127,44 +218,301 @@ class UIDefectInjection:
                f"labeled_path={self.labeled_path}, selected={self.selected})"
 
 
-def el_repeat_content(uidi: UIDefectInjection):
+# strategies that fill the selected element's own box with its dominant color
+PLANNED_FILL_STRATEGIES = ["CONTENT_ERROR", "EL_OVERLAPPING", "EL_SCALING", "EL_MISSING_BLANK", "EL_MISSING_BROKEN_IMG"]
+
+
+# smallest element (width, height) a strategy can inject into: CONTENT_* need a font size of at least 1
+# (height // 2.5), EL_SCALING must still have a pixel left after scaling down by half
+STRATEGY_MIN_SIZE = {"CONTENT_ERROR": (1, 3), "CONTENT_REPEAT": (1, 3), "EL_SCALING": (2, 2)}
+# strategies that rearrange an alignment group and do nothing on a screen without one
+LAYOUT_STRATEGIES = ("EL_MISALIGNED", "UNEVEN_SPACE")
+
+
+def has_layout_group(strategy, analysis: layout.LayoutAnalysis):
+    """Whether the screen has the group a layout strategy rearranges (el_misaligned, uneven_space)."""
+    if strategy == "UNEVEN_SPACE":
+        return analysis.tallest_group("vertical") is not None
+    return analysis.longest_group() is not None
+
+
+def eligible_elements(ui_positions, ui_texts, strategy, frame_size, alignment_el=None):
     """
-    Repeat the selected element's text in the center of the element.
+    Vectorized check of which elements a strategy can actually inject into: the box has an area, is at least
+    partly on screen, is large enough for the strategy and, for CONTENT strategies, has non-empty text.
+    No element is eligible for a layout strategy on a screen without the group it rearranges.
+    :param ui_positions:
+    :param ui_texts:
+    :param strategy: strategy name
+    :param frame_size: (width, height) of the screenshot
+    :param alignment_el: alignment groups of the elements (see identify_aligned_groups), computed for layout
+    strategies if not given
+    :return: boolean mask over ui_positions
+    """
+    mask = bboxes.valid_mask(bboxes.as_boxes(ui_positions, dtype=np.float64), frame_size,
+                             STRATEGY_MIN_SIZE.get(strategy, (1, 1)))
+    if "CONTENT" in strategy:
+        mask &= np.array([bool(text and text.strip()) for text in ui_texts], dtype=bool)
+    if strategy in LAYOUT_STRATEGIES and mask.any():
+        if alignment_el is None:
+            alignment_el = identify_aligned_groups(ui_positions)
+        if not has_layout_group(strategy, layout.analyze_layout(ui_positions, alignment_el)):
+            mask[:] = False
+    return mask
+
+
+def plan_fill_colors(uidi: UIDefectInjection, indices):
+    """
+    Compute the fill colors of all elements selected for one injection in a single pass over the
+    unmodified screenshot, so later defects never sample pixels already changed by earlier ones.
     :param uidi: UIDefectInjection
+    :param indices: selected element indices
     :return:
     """
-    screenshot = Image.open(uidi.image_path)
+    boxes = [uidi.ui_positions[idx] for idx in indices]
+    with profiling.stage("dominant_color"):
+        if strips.over_budget(uidi.image_path):
+            crops = strips.crop_boxes(uidi.image_path, boxes)
+            colors = [array_ops.dominant_color(array_ops.image_to_array(crop.convert('RGB'))) if crop else None
+                      for crop in crops]
+        else:
+            frame = array_ops.image_to_array(load_screenshot(uidi.image_path).convert('RGB'))
+            colors = array_ops.dominant_colors(frame, boxes)
+    uidi.fill_colors = {idx: color for idx, color in zip(indices, colors) if color is not None}
+
+
+class _Frame:
+    """
+    The screenshot being edited by a strategy.
+    With RENDER_BACKEND: numpy (and an RGB/RGBA screenshot) the pixels live in one NumPy array and
+    crops, fills and pastes are slice operations on it; otherwise they are the usual Pillow calls.
+    Element patches returned by crop() are PIL Images or arrays accordingly.
+    A PNG screenshot over FRAME_MEMORY_BUDGET_MB is opened as a window of rows (given by ``rows``):
+    only those rows are decoded, the window grows when an edit reaches outside it, and save() splices
+    it back into the file strip by strip. Coordinates are always screenshot coordinates.
+    """
+
+    def __init__(self, image_path, rows=None):
+        self.top = 0
+        self.windowed = rows is not None and strips.over_budget(image_path)
+        if self.windowed:
+            self.image_path = image_path
+            self.size = strips.PngHeader(image_path).size
+            top, bottom = self._clip_rows(*rows)
+            self.top = top
+            self.image = strips.read_rows(image_path, top, max(bottom, top + 1))
+        else:
+            self.image = load_screenshot(image_path)
+            self.size = self.image.size
+        self.array = None
+        if configs.get("RENDER_BACKEND", "pillow") == "numpy" and self.image.mode in array_ops.SUPPORTED_MODES:
+            self.array = array_ops.image_to_array(self.image)
+
+    def _clip_rows(self, y1, y2):
+        return min(max(int(y1), 0), self.size[1]), min(max(int(math.ceil(y2)), 0), self.size[1])
+
+    def _window(self, y1, y2):
+        """Make sure rows [y1, y2) are loaded, and return the row offset of the window."""
+        if not self.windowed:
+            return 0
+        y1, y2 = self._clip_rows(y1, y2)
+        bottom = self.top + self.image.height
+        if y1 >= self.top and y2 <= bottom:
+            return self.top
+        top, bottom = min(y1, self.top), max(y2, bottom)
+        image = strips.read_rows(self.image_path, top, bottom)
+        image.paste(self._current(), (0, self.top - top))
+        self.top, self.image = top, image
+        if self.array is not None:
+            self.array = array_ops.image_to_array(image)
+        return top
+
+    def _current(self):
+        return self.image if self.array is None else array_ops.array_to_image(self.array, self.image.mode)
+
+    def crop(self, box):
+        if self.windowed:
+            x1, y1, x2, y2 = map(int, map(round, box))
+            top = self._window(y1, y2)
+            box = (x1, y1 - top, x2, y2 - top)
+        if self.array is None:
+            return self.image.crop(box)
+        return array_ops.crop(self.array, box)
+
+    def fill(self, box, color):
+        if self.windowed:
+            x1, y1, x2, y2 = box
+            top = self._window(y1, y2 + 1)
+            box = (x1, int(y1) - top, x2, int(y2) - top)
+        if self.array is None:
+            ImageDraw.Draw(self.image).rectangle(box, fill=color)
+        else:
+            array_ops.fill_rect(self.array, box, color)
+
+    def paste(self, patch, xy):
+        if self.windowed:
+            height = patch.height if self.array is None else patch.shape[0]
+            top = self._window(xy[1], xy[1] + height)
+            xy = (xy[0], xy[1] - top)
+        if self.array is None:
+            self.image.paste(patch, xy)
+        else:
+            array_ops.paste(self.array, patch, xy)
+
+    @contextmanager
+    def region(self, box):
+        """
+        Edit the pixels of box as a PIL Image; they are written back when the block exits.
+        """
+        patch = self.crop(box)
+        if self.array is not None:
+            patch = array_ops.array_to_image(patch, self.image.mode)
+        yield patch
+        if self.array is not None:
+            patch = array_ops.image_to_array(patch)
+        self.paste(patch, (int(round(box[0])), int(round(box[1]))))
+
+    def resize(self, patch, size):
+        if self.array is None:
+            return patch.resize(size)
+        return array_ops.resize(patch, size, self.image.mode)
+
+    def fill_color(self, uidi, patch):
+        """The planned fill color of the selected element, or the dominant color of its patch."""
+        if uidi.selected in uidi.fill_colors:
+            return uidi.fill_colors[uidi.selected]
+        return self.dominant_color(patch)
+
+    def dominant_color(self, patch):
+        if self.array is None:
+            return get_dominant_color(patch)
+        with profiling.stage("dominant_color"):
+            return array_ops.dominant_color(patch)
+
+    def save_patch(self, patch, path):
+        if self.array is not None:
+            patch = array_ops.array_to_image(patch, self.image.mode)
+        patch.save(path)
+
+    def save(self, image_path):
+        if not self.windowed:
+            save_screenshot(self._current(), image_path)
+            return
+        with profiling.stage("encode"):
+            strips.splice_rows(image_path, self.top, self._current())
+
+
+@lru_cache(maxsize=1024)
+def _glyph_mask(font_path, size, text):
+    """
+    Coverage mask of text at a whole-pixel position, and its offset from that position.
+    :return: (L mask, (x offset, y offset))
+    """
+    font = load_font(font_path, size)
+    mask, offset = font.getmask2(text, "L")
+    tile = Image.new("L", mask.size)
+    ImageDraw.Draw(tile).text((-offset[0], -offset[1]), text, fill=255, font=font)
+    return tile, offset
+
+
+def mode_ink(patch, fill):
+    """An RGB fill as ImageDraw takes it for the patch's mode: grey on single-band frames, unchanged otherwise."""
+    if isinstance(fill, tuple) and patch.mode not in ("RGB", "RGBA", "P"):
+        return ImageColor.getcolor("#%02x%02x%02x" % fill[:3], Image.getmodebase(patch.mode))
+    return fill
+
+
+def draw_text(patch, xy, text, fill, size):
+    """
+    Same as ImageDraw.Draw(patch).text(xy, text, fill=fill, font=load_font(FONT_PATH, size)).
+    Text at a whole-pixel position is pasted through a cached glyph mask (the same fill ImageDraw uses),
+    so the few GARBLED_CONTENT strings are rendered once per font size. Other modes (P, L, ...) are drawn by
+    ImageDraw, which resolves the fill for the mode (an RGB fill is converted to grey on single-band frames).
+    """
+    if patch.mode not in ("RGB", "RGBA") or xy[0] != int(xy[0]) or xy[1] != int(xy[1]):
+        ImageDraw.Draw(patch).text(xy, text, fill=mode_ink(patch, fill), font=load_font(configs["FONT_PATH"], size))
+        return
+    mask, offset = _glyph_mask(configs["FONT_PATH"], size, text)
+    patch.paste(fill, (int(xy[0]) + offset[0], int(xy[1]) + offset[1]), mask)
+
+
+def _repeat_content(screenshot, uidi: UIDefectInjection):
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
     center_x, center_y = (x1 + x2) // 2, (y1 + y2) // 2
     x_offset, y_offset = (x2 - x1) // 6, (y2 - y1) // 6
     x_add = center_x + x_offset
     y_add = center_y + y_offset
-    draw = ImageDraw.Draw(screenshot)
-    font = ImageFont.truetype(configs["FONT_PATH"], int(y2 - y1) // 2.5)
-    draw.text((x_add, y_add), uidi.ui_texts[uidi.selected], fill=(57, 57, 57), font=font)
+    size = int(y2 - y1) // 2.5
+    font = load_font(configs["FONT_PATH"], size)
+    text = uidi.ui_texts[uidi.selected]
+    # only the pixels around the text are edited
+    left, top, right, bottom = font.getbbox(text)
+    box = (math.floor(x_add + min(left, 0)) - 1, math.floor(y_add + min(top, 0)) - 1,
+           math.ceil(x_add + right) + 1, math.ceil(y_add + bottom) + 1)
+    with screenshot.region(box) as patch:
+        draw_text(patch, (x_add - box[0], y_add - box[1]), text, (57, 57, 57), size)
+
+
+def el_repeat_content(uidi: UIDefectInjection):
+    """
+    Repeat the selected element's text in the center of the element.
+    :param uidi: UIDefectInjection
+    :return:
+    """
+    x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
+    _repeat_content(screenshot, uidi)
     screenshot.save(uidi.image_path)
 
 
+def _replace_content(screenshot, uidi: UIDefectInjection):
+    text = random.choice(configs["GARBLED_CONTENT"])
+    x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
+    el_width, el_height = x2 - x1, y2 - y1
+    with screenshot.region((x1, y1, x2, y2)) as cropped:
+        size = int(el_height) // 2.5
+        font = load_font(configs["FONT_PATH"], size)
+        draw = ImageDraw.Draw(cropped)
+        text_bbox = draw.textbbox((0, 0), text, font=font)
+        text_x = (el_width - (text_bbox[2] - text_bbox[0])) // 2
+        text_y = (el_height - (text_bbox[3] - text_bbox[1])) // 2
+
+        fill = uidi.fill_colors[uidi.selected] if uidi.selected in uidi.fill_colors else get_dominant_color(cropped)
+        draw.rectangle((0, 0, el_width, el_height), fill=mode_ink(cropped, fill))
+        draw_text(cropped, (text_x, text_y), text, (57, 57, 57), size)
+
+
 def el_replace_content(uidi: UIDefectInjection):
     """
     Replace the selected element with a random string from ['����', 'nullnull'].
     :param uidi: UIDefectInjection
     :return:
     """
-    text = random.choice(configs["GARBLED_CONTENT"])
-    screenshot = Image.open(uidi.image_path)
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
-    el_width, el_height = x2 - x1, y2 - y1
-    cropped = screenshot.crop((x1, y1, x2, y2))
-    font = ImageFont.truetype(configs["FONT_PATH"], int(el_height) // 2.5)
-    draw = ImageDraw.Draw(cropped)
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_x = (el_width - (text_bbox[2] - text_bbox[0])) // 2
-    text_y = (el_height - (text_bbox[3] - text_bbox[1])) // 2
-
-    draw.rectangle((0, 0, el_width, el_height), fill=get_dominant_color(cropped))
-    draw.text((text_x, text_y), text, fill=(57, 57, 57), font=font)
-    screenshot.paste(cropped, (x1, y1))
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
+    _replace_content(screenshot, uidi)
+    screenshot.save(uidi.image_path)
+
+
+# per-element edits of the text strategies, applied to an open _Frame (see el_text_batch)
+TEXT_EDITS = {"CONTENT_ERROR": _replace_content, "CONTENT_REPEAT": _repeat_content}
+
+
+def el_text_batch(uidi: UIDefectInjection, strategy, indices):
+    """
+    Inject a text strategy into several elements in one frame session: the screenshot is loaded once,
+    every element is edited in plan order (the same random draws as one call per element) and it is
+    encoded once, instead of once per element.
+    :param uidi: UIDefectInjection
+    :param strategy: one of TEXT_EDITS
+    :param indices: planned element indices; uidi.selected is left on the last one
+    :return:
+    """
+    edit = TEXT_EDITS[strategy]
+    screenshot = _Frame(uidi.image_path)
+    for idx in indices:
+        uidi.selected = idx
+        edit(screenshot, uidi)
     screenshot.save(uidi.image_path)
 
 
@@ -174,9 +522,9 @@ def el_missing_blank(uidi: UIDefectInjection):
     :param uidi: UIDefectInjection
     :return:
     """
-    screenshot = Image.open(uidi.image_path)
-    screenshot_width, screenshot_height = screenshot.size
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
+    screenshot_width, screenshot_height = screenshot.size
     # 确保裁剪区域在图片范围内
     x1, y1 = max(0, x1), max(0, y1)
     x2, y2 = min(screenshot_width, x2), min(screenshot_height, y2)
@@ -188,9 +536,8 @@ def el_missing_blank(uidi: UIDefectInjection):
     tmp_dir = './tmp'
     if not os.path.exists(tmp_dir):
         os.makedirs(tmp_dir)
-    cropped.save(f"{tmp_dir}/{uuid.uuid4()}.png")
-    draw = ImageDraw.Draw(screenshot)
-    draw.rectangle((x1, y1, x2, y2), fill=get_dominant_color(cropped))
+    screenshot.save_patch(cropped, f"{tmp_dir}/{uuid.uuid4()}.png")
+    screenshot.fill((x1, y1, x2, y2), screenshot.fill_color(uidi, cropped))
     screenshot.save(uidi.image_path)
     return True
 
@@ -204,15 +551,13 @@ def el_missing_broken_img(uidi: UIDefectInjection):
     blank = el_missing_blank(uidi)
     if not blank:
         return
-    broken_img_dir = os.path.join(configs["RESOURCE_DIR"], "broken_images")
-    broken_imgs = [f for f in os.listdir(broken_img_dir) if f.endswith(('png', 'jpg', 'jpeg'))]
+    broken_imgs = load_broken_images(configs["RESOURCE_DIR"])
     if not broken_imgs:
         print(f"No broken images found in {configs['RESOURCE_DIR']}.")
         return
-    broken_img_path = os.path.join(broken_img_dir, random.choice(broken_imgs))
+    broken_img = random.choice(broken_imgs)
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
     el_width, el_height = x2 - x1, y2 - y1
-    broken_img = Image.open(broken_img_path)
     broken_img_w, broken_img_h = broken_img.size
     # Resize the broken image if it is larger than the element
     aspect_ratio = broken_img_w / broken_img_h
@@ -230,13 +575,14 @@ def el_missing_broken_img(uidi: UIDefectInjection):
     new_x1 = max(0, center_x - broken_img_w // 2)
     new_y1 = max(0, center_y - broken_img_h // 2)
     # 读取截图
-    screenshot = Image.open(uidi.image_path)
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
     screenshot_width, screenshot_height = screenshot.size
     # 限制粘贴区域不超出截图范围
     new_x1 = min(new_x1, screenshot_width - broken_img_w)
     new_y1 = min(new_y1, screenshot_height - broken_img_h)
     # uidi.ui_positions[uidi.selected] = [0, 0, 0, 0]
-    screenshot.paste(broken_img, (new_x1, new_y1))
+    with screenshot.region((new_x1, new_y1, new_x1 + broken_img_w, new_y1 + broken_img_h)) as patch:
+        patch.paste(broken_img, (0, 0))
     screenshot.save(uidi.image_path)
 
 
@@ -248,10 +594,9 @@ def el_overlapping(uidi: UIDefectInjection):
     :return:
     """
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
-    screenshot = Image.open(uidi.image_path)
-    draw = ImageDraw.Draw(screenshot)
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
     cropped = screenshot.crop((x1, y1, x2, y2))
-    draw.rectangle((x1, y1, x2, y2), fill=get_dominant_color(cropped))
+    screenshot.fill((x1, y1, x2, y2), screenshot.fill_color(uidi, cropped))
     el_size = identify_el_size(screenshot.size, (x1, y1, x2, y2))
     if el_size == "SMALL":
         x_add, y_add = (x2 - x1) * 1.5, (y2 - y1) * 1.5
@@ -272,9 +617,9 @@ def el_scaling(uidi: UIDefectInjection):
     :param uidi: UIDefectInjection
     :return:
     """
-    screenshot = Image.open(uidi.image_path)
-    w, h = screenshot.size
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
+    w, h = screenshot.size
     el_width, el_height = x2 - x1, y2 - y1
     scale_down = random.uniform(0.5, 0.65)
     scale_up_medium = random.uniform(1.25, 1.5)
@@ -287,9 +632,8 @@ def el_scaling(uidi: UIDefectInjection):
     else:
         new_width, new_height = int(el_width * scale_up), int(el_height * scale_up)
     cropped = screenshot.crop((x1, y1, x2, y2))
-    resized = cropped.resize((new_width, new_height))
-    draw = ImageDraw.Draw(screenshot)
-    draw.rectangle((x1, y1, x2, y2), fill=get_dominant_color(cropped))
+    resized = screenshot.resize(cropped, (new_width, new_height))
+    screenshot.fill((x1, y1, x2, y2), screenshot.fill_color(uidi, cropped))
     center_x, center_y = x1 + el_width // 2, y1 + el_height // 2
     new_x1 = max(0, center_x - new_width // 2)
     new_y1 = max(0, center_y - new_height // 2)
@@ -298,7 +642,7 @@ def el_scaling(uidi: UIDefectInjection):
     uidi.ui_positions[uidi.selected] = [int(new_x1), int(new_y1), int(new_x2), int(new_y2)]
     resized_w, resized_h = new_x2 - new_x1, new_y2 - new_y1
     if resized_w != new_width or resized_h != new_height:
-        resized = resized.resize((resized_w, resized_h))
+        resized = screenshot.resize(resized, (resized_w, resized_h))
     screenshot.paste(resized, (new_x1, new_y1))
     screenshot.save(uidi.image_path)
 
@@ -310,31 +654,18 @@ def el_misaligned(uidi: UIDefectInjection):
     :param uidi: UIDefectInjection
     :return:
     """
-
-    def calculate_average_size(group):
-        """Calculate the average size of elements in a group."""
-        total_area = sum((x2 - x1) * (y2 - y1) for idx in group for x1, y1, x2, y2 in [uidi.ui_positions[idx]])
-        return total_area / len(group) if group else 0
-
-    all_groups = [
-                     ("horizontal", group) for group in uidi.alignment_el.get("horizontal", [])
-                 ] + [
-                     ("vertical", group) for group in uidi.alignment_el.get("vertical", [])
-                 ] + [
-                     ("center_aligned", group) for group in uidi.alignment_el.get("center_aligned", [])
-                 ]
-    if not all_groups:
+    longest = uidi.layout.longest_group()
+    if longest is None:
         return
-    longest_group_type, longest_group = max(all_groups, key=lambda x: (len(x[1]), calculate_average_size(x[1])))
+    longest_group_type, longest_group = longest
 
     uidi.selected = random.choice(longest_group)
     x1, y1, x2, y2 = uidi.ui_positions[uidi.selected]
-    screenshot = Image.open(uidi.image_path)
+    screenshot = _Frame(uidi.image_path, rows=(y1, y2))
     w, h = screenshot.size
     cropped_img = screenshot.crop((x1, y1, x2, y2))
-    cropped_img.save(f'./tmp/{uuid.uuid4()}.png')
-    draw = ImageDraw.Draw(screenshot)
-    draw.rectangle((x1, y1, x2, y2), fill=get_dominant_color(cropped_img))
+    screenshot.save_patch(cropped_img, f'./tmp/{uuid.uuid4()}.png')
+    screenshot.fill((x1, y1, x2, y2), screenshot.dominant_color(cropped_img))
     if longest_group_type == "horizontal":
         y_offset = random.randint(-10, -5)
         uidi.ui_positions[uidi.selected] = (x1, y1 + y_offset, x2, y2 + y_offset)
@@ -355,46 +686,84 @@ def uneven_space(uidi: UIDefectInjection):
     :param uidi: UIDefectInjection
     :return:
     """
-    vertical_groups = uidi.alignment_el.get("vertical", [])
-    if not vertical_groups:
+    tallest = uidi.layout.tallest_group("vertical")
+    if tallest is None:
         return
-    group_heights = [
-        (group, max((uidi.ui_positions[idx][3] - uidi.ui_positions[idx][1]) for idx in group))
-        for group in vertical_groups
-    ]
-    tallest_group, _ = max(group_heights, key=lambda x: x[1])
-    screenshot = Image.open(uidi.image_path)
-    w, h = screenshot.size
-    max_height = 0
-    row_els = []
-    for idx in tallest_group:
-        x1, y1, x2, y2 = uidi.ui_positions[idx]
-        max_height = max(max_height, y2 - y1)
-        uidi.ui_positions[idx] = (0, 0, 0, 0)
-        row_els.append(idx)
-    y1 = min(uidi.ui_positions[idx][1] for idx in row_els)
+    row_els = uidi.layout.group(tallest)
+    _, y1, _, _ = uidi.layout.extent(tallest)
+    max_height = uidi.layout.max_height(tallest)
+    with Image.open(uidi.image_path) as screenshot:
+        w, h = screenshot.size
+    # only the selected element takes the blanked band: the other elements of the row keep their boxes
     uidi.ui_positions[row_els[0]] = (0, y1, w, y1 + max_height)
     uidi.selected = row_els[0]
     el_missing_blank(uidi)
 
 
+# strategies that replace a whole frame of a test case with another frame: they only link files
+FRAME_STRATEGIES = ["UNEXPECTED_TASK_RESULT", "OPERATION_NO_RESPONSE"]
+
+# directory -> (directory key, screenshot paths in directory order, path -> position)
+_frame_indices = {}
+
+
+def _dir_key(directory):
+    stat = os.stat(directory or '.')
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def frame_index(directory):
+    """
+    The PNG screenshots of a directory, as glob.glob(f"{directory}/*.png") lists them, cached until the
+    directory changes (frames written by the frame strategies keep the index up to date).
+    :param directory:
+    :return: (list of paths, dict of path -> position in the list)
+    """
+    key = _dir_key(directory)
+    cached = _frame_indices.get(directory)
+    if cached and cached[0] == key:
+        return cached[1], cached[2]
+    with os.scandir(directory or '.') as entries:
+        paths = [os.path.join(directory, entry.name) for entry in entries
+                 if entry.name.endswith('.png') and not entry.name.startswith('.')]
+    positions = {path: idx for idx, path in enumerate(paths)}
+    _frame_indices[directory] = (key, paths, positions)
+    return paths, positions
+
+
+def _link_frame(src, dst):
+    directory = os.path.dirname(dst)
+    blob_store.share_file(src, dst)
+    cached = _frame_indices.get(directory)
+    if cached:
+        _, paths, positions = cached
+        if dst not in positions:
+            positions[dst] = len(paths)
+            paths.append(dst)
+        _frame_indices[directory] = (_dir_key(directory), paths, positions)
+
+
 def unexpected_task_result(uidi: UIDefectInjection):
     image_path = uidi.image_path
     pre_img = image_path.replace("_1.png", "_0.png")
     selected = image_path.replace("_0.png", "_1.png")
-    non_selected = [pre_img, selected]
-    all_imgs = glob.glob(f"{os.path.dirname(image_path)}/*.png")
-    filtered = [x for x in all_imgs if x not in non_selected]
-    if not filtered:
+    all_imgs, positions = frame_index(os.path.dirname(image_path))
+    non_selected = sorted({positions[path] for path in (pre_img, selected) if path in positions})
+    if len(all_imgs) <= len(non_selected):
         return
-    shutil.copy(random.choice(filtered), selected)
+    # the same draw as random.choice over the frames other than pre_img and selected, without building that list
+    choice = random.randrange(len(all_imgs) - len(non_selected))
+    for position in non_selected:
+        if choice >= position:
+            choice += 1
+    _link_frame(all_imgs[choice], selected)
 
 
 def operation_no_response(uidi: UIDefectInjection):
     image_path = uidi.image_path
     fir_img = image_path.replace("_1.png", "_0.png")
     sec_img = image_path.replace("_0.png", "_1.png")
-    shutil.copy(fir_img, sec_img)
+    _link_frame(fir_img, sec_img)
 
 
 strategies = {
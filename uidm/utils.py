@@ -1,11 +1,16 @@
+import json
+import math
 import os
 import shutil
-import xml.etree.ElementTree as ET
+from functools import lru_cache
 
+import numpy as np
+from lxml import etree
 from PIL import Image, ImageDraw, ImageFont
 
 from config import load_config
-from uidm.ui_defects import UIDefectInjection
+from uidm import bboxes, blob_store, profiling, strips
+from uidm.ui_defects import UIDefectInjection, load_screenshot
 
 configs = load_config()
 
@@ -20,9 +25,7 @@ class UIElement:
 
 
 def get_id_from_element(elem):
-    bounds = elem.attrib["bounds"][1:-1].split("][")
-    x1, y1 = map(int, bounds[0].split(","))
-    x2, y2 = map(int, bounds[1].split(","))
+    x1, y1, x2, y2 = bboxes.parse_bound(elem.attrib["bounds"])
     elem_w, elem_h = x2 - x1, y2 - y1
     if "resource-id" in elem.attrib and elem.attrib["resource-id"]:
         elem_id = elem.attrib["resource-id"].replace(":", ".").replace("/", "_")
@@ -36,63 +39,90 @@ def get_id_from_element(elem):
     return elem_id
 
 
+@lru_cache(maxsize=configs.get("XML_CACHE_SIZE", 128))
+def _parse_xml_cached(xml_path, mtime_ns, size):
+    return etree.parse(xml_path)
+
+
+def load_xml_tree(xml_path):
+    """
+    Parse an XML file with lxml, sharing the parsed tree across callers within a run.
+    Trees are kept in a bounded LRU cache (XML_CACHE_SIZE) keyed by path and mtime/size,
+    so a file rewritten during the run is parsed again.
+    :param xml_path:
+    :return: lxml ElementTree
+    """
+    stat = os.stat(xml_path)
+    return _parse_xml_cached(os.path.abspath(xml_path), stat.st_mtime_ns, stat.st_size)
+
+
 def traverse_tree(xml_path, elem_list, attrib, add_index=False):
-    path = []
+    """
+    Append to elem_list the elements whose attrib is "true", except those whose center is within MIN_DIST
+    of an element already in elem_list. The bounds of all flagged elements are parsed and compared at once.
+    """
     try:
-        for event, elem in ET.iterparse(xml_path, ['start', 'end']):
-            if event == 'start':
-                path.append(elem)
-                if attrib in elem.attrib and elem.attrib[attrib] == "true":
-                    parent_prefix = ""
-                    if len(path) > 1:
-                        parent_prefix = get_id_from_element(path[-2])
-                    bounds = elem.attrib["bounds"][1:-1].split("][")
-                    x1, y1 = map(int, bounds[0].split(","))
-                    x2, y2 = map(int, bounds[1].split(","))
-                    center = (x1 + x2) // 2, (y1 + y2) // 2
-                    elem_id = get_id_from_element(elem)
-                    if parent_prefix:
-                        elem_id = parent_prefix + "_" + elem_id
-                    if add_index:
-                        elem_id += f"_{elem.attrib['index']}"
-                    close = False
-                    for e in elem_list:
-                        bbox = e.bbox
-                        center_ = (bbox[0] + bbox[2]) // 2, (bbox[1] + bbox[3]) // 2
-                        dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-                        if dist <= configs["MIN_DIST"]:
-                            close = True
-                            break
-                    if not close:
-                        elem_list.append(UIElement(elem_id, [x1, y1, x2, y2], attrib, elem.attrib.get("text", "")))
-
-                if event == 'end':
-                    path.pop()
-    except ET.ParseError as e:
+        flagged = []
+        previous = None
+        for elem in load_xml_tree(xml_path).getroot().iter(tag=etree.Element):
+            if attrib in elem.attrib and elem.attrib[attrib] == "true":
+                # the element before it in document order prefixes its id
+                flagged.append((elem, previous))
+            previous = elem
+    except etree.XMLSyntaxError as e:
         print(f"Error parsing XML file {xml_path}: {e}")
+        return
+    boxes = bboxes.parse_bounds([elem.attrib["bounds"] for elem, _ in flagged])
+    kept = bboxes.as_boxes([e.bbox for e in elem_list], dtype=np.int64)
+    for i in bboxes.dedup_by_center(boxes, kept, configs["MIN_DIST"]):
+        elem, previous = flagged[i]
+        elem_id = get_id_from_element(elem)
+        if previous is not None:
+            elem_id = get_id_from_element(previous) + "_" + elem_id
+        if add_index:
+            elem_id += f"_{elem.attrib['index']}"
+        elem_list.append(UIElement(elem_id, boxes[i].tolist(), attrib, elem.attrib.get("text", "")))
 
 
-def extract_xml(xml_path):
+def extract_xml(xml_path, img_size=None):
+    """
+    Clickable and focusable elements of a view hierarchy XML.
+    :param img_size: (width, height) of the screenshot of the XML: boxes are clipped to it, and elements
+    left with no area on it (off screen, or empty bounds) are dropped
+    :return: list of UIElement
+    """
     if not xml_path or not os.path.exists(xml_path):
         return []
+    with profiling.stage("xml_parse"):
+        el_list = _extract_xml(xml_path)
+    if img_size is None or not el_list:
+        return el_list
+    boxes = bboxes.clamp(bboxes.as_boxes([e.bbox for e in el_list], dtype=np.int64), img_size)
+    kept = []
+    for elem, box, valid in zip(el_list, boxes.tolist(), bboxes.valid_mask(boxes)):
+        if valid:
+            elem.bbox = box
+            kept.append(elem)
+    return kept
+
+
+def screenshot_size(image_path):
+    """(width, height) of a screenshot, read from its header, or None if it does not exist."""
+    if not os.path.exists(image_path):
+        return None
+    with Image.open(image_path) as image:
+        return image.size
+
+
+def _extract_xml(xml_path):
     clickable_list = []
     focusable_list = []
     traverse_tree(xml_path, clickable_list, "clickable", True)
     traverse_tree(xml_path, focusable_list, "focusable", True)
     el_list = clickable_list.copy()
-    for elem in focusable_list:
-        bbox = elem.bbox
-        center = (bbox[0] + bbox[2]) // 2, (bbox[1] + bbox[3]) // 2
-        close = False
-        for e in clickable_list:
-            bbox = e.bbox
-            center_ = (bbox[0] + bbox[2]) // 2, (bbox[1] + bbox[3]) // 2
-            dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-            if dist <= configs["MIN_DIST"]:
-                close = True
-                break
-        if not close:
-            el_list.append(elem)
+    near = bboxes.near_mask(bboxes.as_boxes([e.bbox for e in focusable_list], dtype=np.int64),
+                            bboxes.as_boxes([e.bbox for e in clickable_list], dtype=np.int64), configs["MIN_DIST"])
+    el_list.extend(elem for elem, close in zip(focusable_list, near) if not close)
     return el_list if el_list else []
 
 
@@ -108,10 +138,56 @@ def copy_walk_dir(source_folder, destination_folder):
             #     continue
             source_file_path = os.path.join(root, file)
             destination_file_path = os.path.join(target_path, file)
-            shutil.copy(source_file_path, destination_file_path)
+            if file.endswith(".png"):
+                blob_store.copy_file(source_file_path, destination_file_path)
+            else:
+                shutil.copy(source_file_path, destination_file_path)
             print(f"Copied: {source_file_path} to {destination_file_path}")
 
 
+def is_json_array(json_path):
+    """Check whether a JSON file holds a top-level array, reading only up to its first token."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        while True:
+            char = f.read(1)
+            if not char or not char.isspace():
+                return char == '['
+
+
+def iter_json_array(json_path, chunk_size=1 << 16):
+    """
+    Incrementally yield the items of a top-level JSON array without loading the whole file.
+    :param json_path:
+    :param chunk_size: number of characters read at a time
+    :return: generator of decoded items
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path, 'r', encoding='utf-8') as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f"{json_path} is not a JSON array")
+        buf = buf[1:]
+        while True:
+            buf = buf.lstrip(' \t\r\n,')
+            if not buf:
+                buf = f.read(chunk_size)
+                if not buf:
+                    raise ValueError(f"Unterminated JSON array in {json_path}")
+                continue
+            if buf[0] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buf += chunk
+                continue
+            yield item
+            buf = buf[end:]
+
+
 def classify_ui_element(elem):
     """ Classifies UI elements based on XML attributes like class, text, content-desc, and resource-id. """
     class_name = elem.attrib.get("class", "").lower()
@@ -122,9 +198,7 @@ def classify_ui_element(elem):
 
     # Extract width & height for size-based classification
     try:
-        bounds = bounds[1:-1].split("][")
-        x1, y1 = map(int, bounds[0].split(","))
-        x2, y2 = map(int, bounds[1].split(","))
+        x1, y1, x2, y2 = bboxes.parse_bound(bounds)
         width, height = x2 - x1, y2 - y1
     except:
         width, height = 100, 100  # Default size if parsing fails
@@ -178,11 +252,45 @@ def classify_ui_element(elem):
     return ""
 
 
-def screenshot_labeled(uidi: UIDefectInjection, texts=None, extra=[], rgba=(0, 0, 255), thickness=3):
-    screenshot = Image.open(uidi.image_path)
+@lru_cache(maxsize=8)
+def _label_font(font_path, font_size):
+    return ImageFont.truetype(font_path, size=font_size, encoding="utf-8")
+
+
+@lru_cache(maxsize=4096)
+def _label_tile(font_path, font_size, text, fill):
+    """
+    Pre-rendered label (text on its filled tag), cached per font size, text and color.
+    :return: (RGBA tile, tile height); the tile's bottom-left corner goes on the element's top-left corner
+    """
+    font = _label_font(font_path, font_size)
+    left, top, right, bottom = font.getbbox(text)
+    height = math.ceil(bottom * 1.1)
+    tile = Image.new('RGBA', (int(right * 1.1) + 1, height + 1), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(tile)
+    coords = [
+        0, height,
+        right * 1.1, height,
+        right * 1.1, height - bottom * 1.1,
+        0, height - bottom * 1.1
+    ]
+    draw.polygon(coords, fill=fill)
+    draw.text((0, height - bottom * 1.05), text, fill=(255, 255, 255), font=font)
+    return tile, height
+
+
+def render_labels(screenshot, ui_positions, texts=None, extra=[], rgba=(0, 0, 255), thickness=3, top=0,
+                  frame_height=None):
+    """
+    Draw the element boxes and index tags over an in-memory screenshot.
+    Tags come from a per-font-size tile cache, so labeling costs only the overlay drawing.
+    :param top: for a strip of a taller screenshot, the row of the strip in the screenshot
+    :param frame_height: height of the whole screenshot (default: the image height)
+    :return: labeled RGBA image
+    """
     if texts is None:
-        texts = list(map(str, range(len(uidi.ui_positions))))
-    width, height = screenshot.size
+        texts = list(map(str, range(len(ui_positions))))
+    height = frame_height or screenshot.height
     if height < 900:
         font_size = 12
         thickness = 2
@@ -192,29 +300,42 @@ def screenshot_labeled(uidi: UIDefectInjection, texts=None, extra=[], rgba=(0, 0
     else:
         font_size = 42
         thickness = 4
-    font = ImageFont.truetype(configs['FONT_PATH'], size=font_size, encoding="utf-8")
     with screenshot.convert('RGBA') as base:
         tmp = Image.new('RGBA', base.size, (0, 0, 0, 0))
         draw = ImageDraw.Draw(tmp)
-        for idx, ui_position in enumerate(uidi.ui_positions):
+        for idx, ui_position in enumerate(ui_positions):
             x1, y1, x2, y2 = ui_position[:4]
             if x1 == x2 or y1 == y2:
                 continue
-            if [x1, y1, x2, y2] not in extra:
-                draw.rectangle((x1, y1, x2, y2), outline=rgba, width=thickness)
-            else:
-                draw.rectangle((x1, y1, x2, y2), outline=(255, 0, 0), width=thickness)
-            left, top, right, bottom = font.getbbox(texts[idx])
-            coords = [
-                x1, y1,
-                x1 + right * 1.1, y1,
-                x1 + right * 1.1, y1 - bottom * 1.1,
-                x1, y1 - bottom * 1.1
-            ]
-            if [x1, y1, x2, y2] not in extra:
-                draw.polygon(coords, fill=rgba)
-            else:
-                draw.polygon(coords, fill=(255, 0, 0))
-            draw.text((x1, y1 - bottom * 1.05), texts[idx], fill=(255, 255, 255), font=font)
+            color = rgba if [x1, y1, x2, y2] not in extra else (255, 0, 0)
+            tile, tile_height = _label_tile(configs['FONT_PATH'], font_size, texts[idx], color)
+            if y2 < top - thickness or y1 - tile_height >= top + base.height:
+                continue
+            draw.rectangle((x1, y1 - top, x2, y2 - top), outline=color, width=thickness)
+            left, tile_top = int(x1), int(y1) - top - tile_height
+            # alpha_composite only takes non-negative destinations: clip the tile instead
+            source = (max(0, -left), max(0, -tile_top), tile.width, tile.height)
+            if source[0] < source[2] and source[1] < source[3]:
+                tmp.alpha_composite(tile, (max(0, left), max(0, tile_top)), source)
         out = Image.alpha_composite(base, tmp)
     return out
+
+
+def screenshot_labeled(uidi: UIDefectInjection, texts=None, extra=[], rgba=(0, 0, 255), thickness=3):
+    return render_labels(load_screenshot(uidi.image_path), uidi.ui_positions, texts, extra, rgba, thickness)
+
+
+def save_labeled(uidi: UIDefectInjection, labeled_path, texts=None, extra=[]):
+    """
+    Write the labeled screenshot of uidi to labeled_path.
+    Screenshots over FRAME_MEMORY_BUDGET_MB are labeled and encoded strip by strip.
+    """
+    if not strips.over_budget(uidi.image_path):
+        labeled = screenshot_labeled(uidi, texts, extra)
+        blob_store.detach(labeled_path)
+        labeled.save(labeled_path)
+        return
+    size = strips.PngHeader(uidi.image_path).size
+    with strips.PngStripWriter(labeled_path, size, 'RGBA') as writer:
+        for top, strip in strips.iter_strips(uidi.image_path):
+            writer.write(render_labels(strip, uidi.ui_positions, texts, extra, top=top, frame_height=size[1]))
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+from config import load_config
+from uidm import array_ops, blob_store, profiling, strips
+from uidm.ui_defects import load_screenshot
+
+configs = load_config()
+
+
+def snapshot(image_path):
+    """
+    Keep the screenshot as it is before injection.
+    The file is hardlinked rather than copied: strategies never write a screenshot in place (see
+    blob_store.detach), so the link keeps the original content. Screenshots within the memory budget
+    are also kept decoded, which costs no extra decode since the strategies read the same cached frame.
+    :return: (snapshot path, decoded frame or None)
+    """
+    snapshot_path = f'{image_path}.{os.getpid()}.orig'
+    blob_store.link(image_path, snapshot_path)
+    frame = None if strips.over_budget(image_path) else load_screenshot(image_path)
+    return snapshot_path, frame
+
+
+def restore(snapshot_path, image_path):
+    """Put the original screenshot back to inject again."""
+    blob_store.link(snapshot_path, image_path)
+
+
+def discard(snapshot_path):
+    try:
+        os.remove(snapshot_path)
+    except FileNotFoundError:
+        pass
+
+
+def touched_box(before, after):
+    """
+    Box an element's defect may have changed: the union of the element's box before and after injection
+    (strategies that move or scale an element change both). Boxes with no area are ignored.
+    """
+    boxes = [box[:4] for box in (before, after) if box[2] > box[0] and box[3] > box[1]]
+    if not boxes:
+        return None
+    x1, y1, x2, y2 = np.asarray(boxes, dtype=np.float64).T
+    return x1.min(), y1.min(), x2.max(), y2.max()
+
+
+def _crops(image_path, boxes, frame=None):
+    if frame is None and strips.over_budget(image_path):
+        return strips.crop_boxes(image_path, boxes)
+    frame = frame or load_screenshot(image_path)
+    return [frame.crop(tuple(map(int, map(round, box)))) for box in boxes]
+
+
+def changed_fraction(original, injected, tolerance):
+    """
+    Fraction of pixels of a crop whose largest channel difference exceeds tolerance.
+    """
+    if original is None or injected is None or original.width == 0 or original.height == 0:
+        return 0.0
+    a = array_ops.image_to_array(original.convert('RGB')).astype(np.int16)
+    b = array_ops.image_to_array(injected.convert('RGB')).astype(np.int16)
+    return float((np.abs(a - b).max(axis=2) > tolerance).mean())
+
+
+def visible_defects(image_path, snapshot_path, original_frame, original_positions, ui_positions, selected):
+    """
+    Diff the boxes touched by each defect against the original screenshot.
+    A defect is visible when more than VERIFY_MIN_CHANGED of the pixels in its box changed by more than
+    VERIFY_PIXEL_TOLERANCE in some channel.
+    :param selected: injected_defect["selected"] entries, "<idx>|<box>"
+    :return: the visible entries of selected
+    """
+    tolerance = configs.get("VERIFY_PIXEL_TOLERANCE", 12)
+    min_changed = configs.get("VERIFY_MIN_CHANGED", 0.02)
+    indices = [int(entry.split("|", 1)[0]) for entry in selected]
+    boxes = [touched_box(original_positions[idx], ui_positions[idx]) for idx in indices]
+    kept = [i for i, box in enumerate(boxes) if box is not None]
+    with profiling.stage("verify"):
+        before = _crops(snapshot_path, [boxes[i] for i in kept], original_frame)
+        after = _crops(image_path, [boxes[i] for i in kept])
+        visible = {i for i, a, b in zip(kept, before, after) if changed_fraction(a, b, tolerance) > min_changed}
+    profiling.count("invisible_defects", len(selected) - len(visible))
+    return [entry for i, entry in enumerate(selected) if i in visible]
@@ -1,11 +1,21 @@
+import asyncio
+import copy
+import functools
 import json
 import os
 import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import asdict
 
+import numpy as np
+from PIL import Image
+
 from config import load_config
-from uidm import utils
-from uidm.ui_defects import UIDefectInjection, strategies
+from uidm import blob_store, frames, memprofile, pipeline, profiling, schedule, strips, utils, verify
+from uidm.ui_defects import (FRAME_STRATEGIES, PLANNED_FILL_STRATEGIES, TEXT_EDITS, UIDefectInjection,
+                             el_text_batch, eligible_elements, plan_fill_colors, prime_frame, strategies)
 
 configs = load_config()
 
@@ -16,79 +26,441 @@ difficulties = {
 }
 
 
-def ui_defect_mocker(screenshot_path, ui_positions, ui_texts, difficulty=None, selected=None):
+def _boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def plan_elements(ui_positions, candidates, count):
+    """
+    Pick up to count elements from candidates without replacement, skipping elements whose box
+    overlaps an element already picked, so no defect samples or covers pixels corrupted by another.
+    :param ui_positions:
+    :param candidates: indices eligible for the selected strategy
+    :param count: number of defects wanted for the difficulty
+    :return: list of selected indices
+    """
+    candidates = list(candidates)
+    planned = []
+    while candidates and len(planned) < count:
+        idx = random.choice(candidates)
+        candidates.remove(idx)
+        if any(_boxes_overlap(ui_positions[idx], ui_positions[other]) for other in planned):
+            continue
+        planned.append(idx)
+    return planned
+
+
+def run_strategy(strategy, uidi):
+    with profiling.tagged(strategy=strategy, difficulty=uidi.difficulty), profiling.stage("strategy"):
+        profiling.count("injections")
+        return strategies[strategy](uidi)
+
+
+def select_elements(ui_positions, ui_texts, selected_strategy, frame_size, difficulty, fallback=True,
+                    alignment_el=None):
+    """
+    Pick the elements to inject selected_strategy into: the eligible elements planned for the difficulty.
+    Reads no pixels, so a dry run plans with it too.
+    :param fallback: draw another strategy if selected_strategy has no eligible element
+    :param alignment_el: alignment groups of the elements, see eligible_elements
+    :return: (strategy, list of element indices)
+    """
+    eligible = eligible_elements(ui_positions, ui_texts, selected_strategy, frame_size, alignment_el)
+    if not eligible.any() and fallback:
+        candidates = schedule.eligible_strategies(ui_positions, ui_texts, frame_size, alignment_el=alignment_el)
+        if candidates:
+            selected_strategy = schedule.choose_strategy(candidates)
+            eligible = eligible_elements(ui_positions, ui_texts, selected_strategy, frame_size, alignment_el)
+    profiling.count("ineligible", int(len(eligible) - eligible.sum()))
+    return selected_strategy, plan_elements(ui_positions, np.flatnonzero(eligible).tolist(), difficulties[difficulty])
+
+
+def inject_elements(uidi, selected_strategy, injected_defect, fallback=True, planned=None):
+    """
+    Inject selected_strategy into the eligible elements planned for the difficulty.
+    :param fallback: draw another strategy if selected_strategy has no eligible element
+    :param planned: element indices to inject, as planned by a dry run, instead of selecting them
+    :return: the strategy injected, or None if no element was eligible
+    """
+    if planned is None:
+        with Image.open(uidi.image_path) as screenshot:
+            frame_size = screenshot.size
+        selected_strategy, planned = select_elements(uidi.ui_positions, uidi.ui_texts, selected_strategy, frame_size,
+                                                     uidi.difficulty, fallback, uidi.alignment_el)
+    if not planned:
+        return None
+    if len(planned) > 1 and selected_strategy in PLANNED_FILL_STRATEGIES:
+        plan_fill_colors(uidi, planned)
+    if len(planned) > 1 and selected_strategy in TEXT_EDITS and not strips.over_budget(uidi.image_path):
+        with profiling.tagged(strategy=selected_strategy, difficulty=uidi.difficulty), profiling.stage("strategy"):
+            profiling.count("injections", len(planned))
+            el_text_batch(uidi, selected_strategy, planned)
+        for idx in planned:
+            injected_defect["selected"].append(f"{idx}|{uidi.ui_positions[idx]}")
+        return selected_strategy
+    for idx in planned:
+        uidi.selected = idx
+        run_strategy(selected_strategy, uidi)
+        injected_defect["selected"].append(f"{uidi.selected}|{uidi.ui_positions[uidi.selected]}")
+    return selected_strategy
+
+
+def inject_verified(uidi, selected_strategy, injected_defect, fallback=True, planned=None):
+    """
+    inject_elements, keeping only the defects that visibly changed the screenshot when VERIFY_INJECTION is set.
+    An injection with no visible defect is undone and drawn again, up to VERIFY_RETRIES times.
+    :return: the strategy injected, or None if no (visible) defect was injected
+    """
+    if not configs.get("VERIFY_INJECTION", False):
+        return inject_elements(uidi, selected_strategy, injected_defect, fallback, planned)
+    original_positions = copy.deepcopy(uidi.ui_positions)
+    snapshot_path, original_frame = verify.snapshot(uidi.image_path)
+    try:
+        for attempt in range(configs.get("VERIFY_RETRIES", 2) + 1):
+            if attempt:
+                profiling.count("verify_retries")
+                verify.restore(snapshot_path, uidi.image_path)
+                uidi.ui_positions[:] = copy.deepcopy(original_positions)
+                uidi.fill_colors = {}
+                injected_defect["selected"] = []
+            injected = inject_elements(uidi, selected_strategy, injected_defect, fallback, planned)
+            if injected is None:
+                return None
+            injected_defect["selected"] = verify.visible_defects(uidi.image_path, snapshot_path, original_frame,
+                                                                 original_positions, uidi.ui_positions,
+                                                                 injected_defect["selected"])
+            if injected_defect["selected"]:
+                return injected
+        verify.restore(snapshot_path, uidi.image_path)
+        uidi.ui_positions[:] = copy.deepcopy(original_positions)
+        return None
+    finally:
+        verify.discard(snapshot_path)
+
+
+@memprofile.track
+def ui_defect_mocker(screenshot_path, ui_positions, ui_texts, difficulty=None, selected=None, record=None,
+                     strategy=None, planned=None):
+    """
+    :param record: with JSON_RECORD, the JsonArrayWriter of the run the record of an injected screenshot is
+    written to (None: not recorded)
+    """
     injected_defect = {
         "idx": selected,
         "strategy": "",
         "selected": [],
     }
-    uidi = UIDefectInjection(screenshot_path, ui_positions, ui_texts)
+    selected_strategy = strategy or schedule.choose_strategy(configs["STRATEGY"])
+    # frame-level strategies only link files of the test case, they skip the element analysis
+    alignment_el = {} if selected_strategy in FRAME_STRATEGIES else None
+    uidi = UIDefectInjection(screenshot_path, ui_positions, ui_texts, alignment_el=alignment_el)
     if difficulty:
         uidi.difficulty = difficulty
-    selected_strategy = random.choice(configs["STRATEGY"])
     if len(uidi.ui_positions) == 0:
         return uidi
-    defect_cnt = difficulties[uidi.difficulty]
-    if "CONTENT" in selected_strategy:
-        non_empty_text_indices = [idx for idx, text in enumerate(uidi.ui_texts) if text.strip()]
-        if non_empty_text_indices:
-            while defect_cnt > 0 and non_empty_text_indices:
-                uidi.selected = random.choice(non_empty_text_indices)
-                non_empty_text_indices.remove(uidi.selected)
-                strategies[selected_strategy](uidi)
-                defect_cnt -= 1
-                injected_defect["selected"].append(f"{uidi.selected}|{ui_positions[uidi.selected]}")
-        else:
-            selected_strategy = random.choice(configs["STRATEGY"][2:])
-            while defect_cnt > 0:
-                uidi.selected = random.choice(range(len(uidi.ui_positions)))
-                strategies[selected_strategy](uidi)
-                defect_cnt -= 1
-                injected_defect["selected"].append(f"{uidi.selected}|{ui_positions[uidi.selected]}")
+    if selected_strategy in FRAME_STRATEGIES:
+        run_strategy(selected_strategy, uidi)
     else:
-        while defect_cnt > 0:
-            uidi.selected = random.choice(range(len(uidi.ui_positions)))
-            strategies[selected_strategy](uidi)
-            defect_cnt -= 1
-            injected_defect["selected"].append(f"{uidi.selected}|{ui_positions[uidi.selected]}")
-
-        # uidi.selected = random.choice(range(len(uidi.ui_positions)))
+        selected_strategy = inject_verified(uidi, selected_strategy, injected_defect, fallback=strategy is None,
+                                            planned=planned)
+        if selected_strategy is None:
+            return uidi
     # strategies[selected_strategy](uidi)
     injected_defect['selected'] = list(dict.fromkeys(injected_defect['selected']))
     injected_defect['strategy'] = selected_strategy
     uidi.injected_defect = injected_defect
     # uidi.injected_defect = f'{selected_strategy}|{uidi.selected}|{uidi.ui_positions[uidi.selected]}'
+    tags = {"strategy": selected_strategy, "difficulty": uidi.difficulty}
     if configs["OUTPUT_WITH_LABELED"]:
-        uidi.labeled_path = os.path.join(configs['SAVED_DIR'], f"labeled_{os.path.basename(uidi.image_path)}")
-        labeled = utils.screenshot_labeled(uidi)
-        labeled.save(uidi.labeled_path)
-    if not configs['JSON_RECORD']:
+        with profiling.stage("labeling", **tags):
+            uidi.labeled_path = os.path.join(configs['SAVED_DIR'], f"labeled_{os.path.basename(uidi.image_path)}")
+            utils.save_labeled(uidi, uidi.labeled_path)
+    if not configs['JSON_RECORD'] or record is None:
         return uidi
-    uidi_dict = asdict(uidi)
+    with profiling.stage("json_record", **tags):
+        record.write(asdict(uidi))
+    return uidi
+
+
+def plan_injection(screenshot_path, ui_positions, ui_texts, difficulty=None, selected=None, strategy=None):
+    """
+    Dry-run counterpart of ui_defect_mocker: draw the strategy and the elements it would inject without
+    touching pixels (only the screenshot header is read, for its size).
+    :return: plan entry {"strategy", "difficulty", "idx", "selected", "boxes", "seed"}, or None if nothing
+    would be injected. selected and boxes are empty for frame-level strategies.
+    """
+    if len(ui_positions) == 0:
+        return None
+    selected_strategy = strategy or schedule.choose_strategy(configs["STRATEGY"])
+    difficulty = difficulty or "simple"
+    planned = []
+    if selected_strategy not in FRAME_STRATEGIES:
+        with Image.open(screenshot_path) as screenshot:
+            frame_size = screenshot.size
+        selected_strategy, planned = select_elements(ui_positions, ui_texts, selected_strategy, frame_size, difficulty,
+                                                     fallback=strategy is None)
+        if not planned:
+            return None
+    return {
+        "strategy": selected_strategy,
+        "difficulty": difficulty,
+        "idx": selected,
+        "selected": planned,
+        "boxes": [list(ui_positions[idx][:4]) for idx in planned],
+        # the strategies draw colours, offsets and texts at random; the executor seeds with it to apply the plan as written
+        "seed": random.getrandbits(32),
+    }
+
+
+def inject_planned(screenshot_path, ui_positions, ui_texts, entry, record=None):
+    """
+    Apply a plan entry of plan_injection: inject its strategy into its elements, seeded as planned.
+    """
+    random.seed(entry["seed"])
+    return ui_defect_mocker(screenshot_path, ui_positions, ui_texts, difficulty=entry["difficulty"],
+                            selected=entry.get("idx"), record=record, strategy=entry["strategy"],
+                            planned=entry["selected"] or None)
+
+
+def record_path():
+    """Path of the JSON records of a run: <SAVED_DIR>/<name of SAVED_DIR>.json"""
     saved_dir = configs['SAVED_DIR']
-    json_path = os.path.join(saved_dir, f'{os.path.basename(saved_dir)}.json')
-    if os.path.exists(json_path):
-        with open(json_path, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                data = []
-        data.append(uidi_dict)
+    return os.path.join(saved_dir, f'{os.path.basename(saved_dir)}.json')
+
+
+def _iter_screenshot_items(input_dir, xml_dir):
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.png'):
+                yield entry.name, os.path.join(xml_dir, entry.name.replace(".png", ".xml"))
+
+
+def plan_corpus(input_dir, xml_dir, schedule_path):
+    """
+    Assign a strategy to every screenshot of input_dir up front, so a run produces exactly the
+    STRATEGY_QUOTAS mix, and write the schedule to schedule_path.
+    Screenshots with no element eligible for any strategy are left out of the schedule.
+    :return: dict of screenshot -> strategy
+    """
+    eligibility = {}
+    for screenshot, xml_path in _iter_screenshot_items(input_dir, xml_dir):
+        frame_size = utils.screenshot_size(os.path.join(input_dir, screenshot))
+        el_list = utils.extract_xml(xml_path, frame_size)
+        eligibility[screenshot] = schedule.eligible_strategies([el.bbox for el in el_list],
+                                                               [el.text for el in el_list], frame_size)
+    plan = schedule.plan_schedule(eligibility)
+    schedule.write_schedule(plan, schedule_path)
+    print(f"Planned {len(plan)} of {len(eligibility)} screenshots: {dict(Counter(plan.values()))}")
+    return plan
+
+
+def load_plan(input_dir, xml_dir):
+    """
+    The STRATEGY_SCHEDULE of this run, planned first if the schedule file does not exist yet.
+    :return: dict of screenshot -> strategy, or None without a schedule
+    """
+    schedule_path = configs.get("STRATEGY_SCHEDULE", "")
+    if not schedule_path:
+        return None
+    if os.path.exists(schedule_path):
+        return schedule.load_schedule(schedule_path)
+    return plan_corpus(input_dir, xml_dir, schedule_path)
+
+
+def dry_run(input_dir, xml_dir, plan, plan_path):
+    """
+    DRY_RUN: extract the XML of every screenshot of input_dir and select its strategy and elements, then
+    write the injection plan to plan_path (a JSON array of plan_injection entries with their "screenshot"
+    and "xml"). No screenshot is copied, decoded or encoded.
+    :return: number of entries planned
+    """
+    strategy_mix = Counter()
+    input_bytes = 0
+    with pipeline.JsonArrayWriter(plan_path, indent=2, append=False) as writer:
+        for screenshot, xml_path, strategy, _ in _iter_planned_items(input_dir, xml_dir, plan):
+            screenshot_path = os.path.join(input_dir, screenshot)
+            el_list = utils.extract_xml(xml_path, utils.screenshot_size(screenshot_path))
+            entry = plan_injection(screenshot_path, [el.bbox for el in el_list], [el.text for el in el_list],
+                                   strategy=strategy)
+            if entry is None:
+                continue
+            writer.write({"screenshot": screenshot, "xml": xml_path, **entry})
+            strategy_mix[entry["strategy"]] += 1
+            input_bytes += os.path.getsize(screenshot_path)
+    print_plan_summary(os.path.basename(os.path.normpath(input_dir)), strategy_mix, input_bytes)
+    return sum(strategy_mix.values())
+
+
+def print_plan_summary(app, strategy_mix, input_bytes):
+    """
+    Print what a dry run planned for one app: the strategy mix and the expected output size (every planned
+    screenshot is written once more, and again labeled with OUTPUT_WITH_LABELED).
+    """
+    copies = 2 if configs["OUTPUT_WITH_LABELED"] else 1
+    print(f"{app}: {sum(strategy_mix.values())} screenshots planned, {dict(strategy_mix)}, "
+          f"about {input_bytes * copies / (1 << 20):.1f} MB of output")
+
+
+# keys of every plan entry, see plan_injection
+PLAN_KEYS = ("strategy", "difficulty", "idx", "selected", "seed")
+
+
+def load_injection_plan(keys=("screenshot", "xml")):
+    """
+    The INJECTION_PLAN written by a dry run, to be applied as written.
+    :param keys: keys the dry run of this driver adds to locate the screenshot of an entry
+    (uidm_main: "screenshot" and "xml")
+    :return: list of plan entries, or None without a plan
+    """
+    plan_path = configs.get("INJECTION_PLAN", "")
+    if not plan_path or configs.get("DRY_RUN", False) or not os.path.exists(plan_path):
+        return None
+    entries = list(utils.iter_json_array(plan_path))
+    for i, entry in enumerate(entries):
+        missing = [key for key in (*keys, *PLAN_KEYS) if key not in entry]
+        if missing:
+            raise ValueError(f"{plan_path}: entry {i} has no {', '.join(missing)}; "
+                             f"an injection plan is applied by the driver whose dry run wrote it")
+    return entries
+
+
+def _iter_planned_items(input_dir, xml_dir, plan, injection_plan=None):
+    if injection_plan is not None:
+        for entry in injection_plan:
+            yield entry["screenshot"], entry["xml"], entry["strategy"], entry
+        return
+    for screenshot, xml_path in _iter_screenshot_items(input_dir, xml_dir):
+        if plan is None:
+            yield screenshot, xml_path, None, None
+        elif screenshot in plan:
+            yield screenshot, xml_path, plan[screenshot], None
+
+
+def _prefetch_screenshot(item):
+    screenshot, xml_path, strategy, entry = item
+    image_path = os.path.join(configs["SAVED_DIR"], screenshot)
+    if configs["INPUT_DIR"] != configs["SAVED_DIR"]:
+        blob_store.copy_file(os.path.join(configs["INPUT_DIR"], screenshot), image_path)
+    el_list = utils.extract_xml(xml_path, utils.screenshot_size(image_path))
+    return image_path, [el.bbox for el in el_list], [el.text for el in el_list], strategy, entry
+
+
+def _inject_screenshot(prefetched):
+    """
+    :return: record of the screenshot, or None if nothing was injected (not recorded, as in the serial loop)
+    """
+    image_path, ui_positions, ui_texts, strategy, entry = prefetched
+    if entry is not None:
+        uidi = inject_planned(image_path, ui_positions, ui_texts, entry)
     else:
-        data = [uidi_dict]
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4)
-    return uidi
+        uidi = ui_defect_mocker(image_path, ui_positions, ui_texts, strategy=strategy)
+    return asdict(uidi) if uidi.injected_defect else None
+
+
+def _prefetch_shared(pool, item):
+    """
+    Prefetch, then decode the screenshot into a slot of the frame pool (SHARED_FRAMES).
+    Screenshots the pool can not hold, or get no slot within SHARED_FRAME_TIMEOUT seconds (slots of a worker
+    that died are never released), are left to the worker to decode.
+    """
+    image_path, ui_positions, ui_texts, strategy, entry = _prefetch_screenshot(item)
+    handle = None
+    if image_path.lower().endswith('.png') and not strips.over_budget(image_path):
+        with profiling.stage("decode"), Image.open(image_path) as image:
+            image.load()
+            handle = pool.put(image, ui_positions, timeout=configs.get("SHARED_FRAME_TIMEOUT", 5))
+    if handle is None:
+        return image_path, ui_positions, ui_texts, strategy, entry, None
+    return image_path, None, ui_texts, strategy, entry, handle
+
+
+def _inject_shared(prefetched):
+    image_path, ui_positions, ui_texts, strategy, entry, handle = prefetched
+    if handle is not None:
+        pool = frames.worker_pool()
+        try:
+            prime_frame(pool.image(handle), image_path)
+            ui_positions = pool.positions(handle).tolist()
+        finally:
+            pool.release(handle)
+    return _inject_screenshot((image_path, ui_positions, ui_texts, strategy, entry))
+
+
+def _profiled(process, prefetched):
+    """Run process in a worker and return its result with the profiling the worker recorded (PROFILING)."""
+    result = process(prefetched)
+    return result, profiling.take()
+
+
+async def run_async(input_dir, xml_dir, plan=None, injection_plan=None):
+    """
+    Asyncio pipeline mode (ASYNC_PIPELINE): screenshots are streamed from INPUT_DIR, copied to SAVED_DIR
+    and their XML parsed with PIPELINE_CONCURRENCY items in flight, injection runs in a pool of
+    PIPELINE_WORKERS processes, and JSON records are appended by a single writer as results complete.
+    With SHARED_FRAMES, screenshots are decoded during prefetch into a shared memory frame pool and the
+    workers receive a handle instead of decoding them again.
+    Only the screenshots themselves are copied to SAVED_DIR in this mode. A failed run keeps the previous
+    JSON records.
+    With an injection_plan (see load_injection_plan), its entries are applied instead of drawing strategies.
+    With PROFILING, each worker returns the stages it recorded with its result and they are merged into the
+    run report.
+    """
+    os.makedirs(configs["SAVED_DIR"], exist_ok=True)
+    concurrency = configs.get("PIPELINE_CONCURRENCY", 8)
+    pool = None
+    prefetch, process, pool_args = _prefetch_screenshot, _inject_screenshot, {}
+    if configs.get("SHARED_FRAMES", False):
+        pool = frames.FramePool(configs.get("SHARED_FRAME_SLOTS") or concurrency,
+                                int(configs.get("SHARED_FRAME_SLOT_MB", 16) * (1 << 20)))
+        prefetch, process = functools.partial(_prefetch_shared, pool), _inject_shared
+        pool_args = {"initializer": frames.connect, "initargs": (pool.spec(),)}
+    try:
+        with (pipeline.JsonArrayWriter(record_path()) if configs["JSON_RECORD"] else nullcontext()) as writer, \
+                ProcessPoolExecutor(max_workers=configs.get("PIPELINE_WORKERS") or None, **pool_args) as executor:
+            sink = writer.write if writer else None
+            if profiling.profiler.enabled:
+                process = functools.partial(_profiled, process)
+
+                def sink(profiled):
+                    result, worker_profile = profiled
+                    profiling.merge(worker_profile)
+                    if writer and result is not None:
+                        writer.write(result)
+            await pipeline.run_pipeline(
+                _iter_planned_items(input_dir, xml_dir, plan, injection_plan),
+                prefetch,
+                process,
+                sink=sink,
+                concurrency=concurrency,
+                executor=executor,
+            )
+    finally:
+        if pool:
+            pool.close()
 
 
 if __name__ == '__main__':
     input_dir = configs["INPUT_DIR"]
     saved_dir = configs["SAVED_DIR"]
     xml_dir = configs["XML_DIR"]
-    if input_dir != saved_dir:
-        utils.copy_walk_dir(input_dir, saved_dir)
-    screenshots = [f for f in os.listdir(input_dir) if f.endswith('.png')]
-    for screenshot in screenshots:
-        xml_path = os.path.join(xml_dir, f'{os.path.basename(screenshot).replace(".png", ".xml")}')
-        el_list = utils.extract_xml(xml_path)
-        ui_defect_mocker(screenshot, [el.bbox for el in el_list], [el.text for el in el_list])
+    plan = load_plan(input_dir, xml_dir)
+    injection_plan = load_injection_plan()
+    if configs.get("DRY_RUN", False):
+        dry_run(input_dir, xml_dir, plan, configs.get("INJECTION_PLAN") or "injection_plan.json")
+    elif configs.get("ASYNC_PIPELINE", False):
+        asyncio.run(run_async(input_dir, xml_dir, plan, injection_plan))
+    else:
+        if input_dir != saved_dir:
+            utils.copy_walk_dir(input_dir, saved_dir)
+        with pipeline.JsonArrayWriter(record_path()) if configs["JSON_RECORD"] else nullcontext() as writer:
+            for screenshot, xml_path, strategy, entry in _iter_planned_items(input_dir, xml_dir, plan,
+                                                                              injection_plan):
+                el_list = utils.extract_xml(xml_path, utils.screenshot_size(screenshot))
+                if entry is not None:
+                    inject_planned(screenshot, [el.bbox for el in el_list], [el.text for el in el_list], entry,
+                                   record=writer)
+                else:
+                    ui_defect_mocker(screenshot, [el.bbox for el in el_list], [el.text for el in el_list],
+                                     record=writer, strategy=strategy)
+    profiling.report()
+    memprofile.report()
@@ -0,0 +1,197 @@
+import base64
+import json
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import load_config
+from uidm import utils
+from uidm.ui_defects import load_broken_images, load_font
+import uidm_main
+from uidm_main import ui_defect_mocker
+
+configs = load_config()
+
+
+def _warm_worker():
+    """
+    Runs once in every worker process: labeling is done per request, and the label fonts and broken-image
+    assets are loaded before the first request comes in.
+    """
+    uidm_main.configs["OUTPUT_WITH_LABELED"] = False
+    for size in (12, 18, 42):
+        utils._label_font(configs["FONT_PATH"], size)
+    load_font(configs["FONT_PATH"], configs["FONT_SIZE"])
+    load_broken_images(configs["RESOURCE_DIR"])
+
+
+def inject_item(item):
+    """
+    Inject defects into one screenshot of a request (runs in a worker process).
+    The item gives either ``image_path`` (injected in place, as ui_defect_mocker does) or ``image``
+    (base64 PNG bytes, injected in a temporary directory and returned), plus ``ui_positions``, ``ui_texts``
+    and optionally ``difficulty``, ``strategy``, ``seed`` and ``labeled``. The labeled screenshot is drawn in
+    a temporary directory and only returned, never left on disk.
+    :return: {"record": ..., "image": base64 PNG (bytes input only), "labeled": base64 PNG (if labeled)}
+    """
+    tmp_dir = None
+    try:
+        image_path = item.get("image_path")
+        inline = image_path is None
+        if inline or item.get("labeled"):
+            tmp_dir = tempfile.mkdtemp(prefix="uidm_")
+        if inline:
+            image_path = os.path.join(tmp_dir, "screenshot_0.png")
+            with open(image_path, 'wb') as f:
+                f.write(base64.b64decode(item["image"]))
+        if item.get("seed") is not None:
+            random.seed(item["seed"])
+        uidi = ui_defect_mocker(image_path, item["ui_positions"], item.get("ui_texts") or [""] * len(item["ui_positions"]),
+                                difficulty=item.get("difficulty"), strategy=item.get("strategy"))
+        result = {}
+        if item.get("labeled"):
+            labeled_path = os.path.join(tmp_dir, f"labeled_{os.path.basename(image_path)}")
+            utils.save_labeled(uidi, labeled_path)
+            with open(labeled_path, 'rb') as f:
+                result["labeled"] = base64.b64encode(f.read()).decode('ascii')
+        if inline:
+            with open(image_path, 'rb') as f:
+                result["image"] = base64.b64encode(f.read()).decode('ascii')
+            uidi.image_path = ""
+        result["record"] = asdict(uidi)
+        return result
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class InjectionService:
+    """
+    A pool of warm worker processes with a bounded number of screenshots in flight.
+    A batch that does not fit in the free slots is rejected at once, so callers back off instead of
+    queueing unbounded work.
+    """
+
+    def __init__(self, workers=None, max_in_flight=32):
+        self.executor = ProcessPoolExecutor(max_workers=workers or None, initializer=_warm_worker)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def try_reserve(self, n):
+        with self.lock:
+            if self.in_flight + n > self.max_in_flight:
+                return False
+            self.in_flight += n
+            return True
+
+    def release(self, n):
+        with self.lock:
+            self.in_flight -= n
+
+    def inject(self, items):
+        """
+        :return: results in item order, or None if the service is saturated
+        """
+        if not self.try_reserve(len(items)):
+            return None
+        try:
+            futures = [self.executor.submit(inject_item, item) for item in items]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append({"error": repr(e)})
+            return results
+        finally:
+            self.release(len(items))
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class InjectionHandler(BaseHTTPRequestHandler):
+    """
+    POST /inject  {"items": [...]}  ->  {"results": [...]}   (see inject_item)
+    GET  /health                    ->  {"status": "ok", "in_flight": n}
+    """
+    service: InjectionService = None
+
+    def _reply(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._reply(404, {"error": "not found"})
+            return
+        self._reply(200, {"status": "ok", "in_flight": self.service.in_flight})
+
+    def do_POST(self):
+        if self.path != "/inject":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            items = request["items"]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": f"bad request: {e!r}"})
+            return
+        if len(items) > self.service.max_in_flight:
+            self._reply(413, {"error": f"at most {self.service.max_in_flight} items per request"})
+            return
+        results = self.service.inject(items)
+        if results is None:
+            self._reply(503, {"error": "busy"}, {"Retry-After": "1"})
+            return
+        self._reply(200, {"results": results})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        self.server_name, self.server_port = "localhost", 0
+
+
+def make_server(service):
+    """
+    HTTP server for the service, on SERVICE_SOCKET (a Unix socket path) if set, else on SERVICE_HOST:SERVICE_PORT.
+    """
+    handler = type("Handler", (InjectionHandler,), {"service": service})
+    if configs.get("SERVICE_SOCKET"):
+        return UnixHTTPServer(configs["SERVICE_SOCKET"], handler)
+    return ThreadingHTTPServer((configs.get("SERVICE_HOST", "127.0.0.1"), configs.get("SERVICE_PORT", 8765)), handler)
+
+
+if __name__ == '__main__':
+    service = InjectionService(configs.get("SERVICE_WORKERS") or None, configs.get("SERVICE_MAX_IN_FLIGHT", 32))
+    server = make_server(service)
+    print(f"Serving defect injection on {server.server_address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()